@@ -0,0 +1,329 @@
+import sys
+import os
+import io
+import json
+import time
+import random
+import shutil
+import tempfile
+import resource
+import subprocess
+import contextlib
+
+import project3
+from project3 import BTreeFile, split_options, int_option
+
+# Benchmarks every command of project3.py through the BTreeFile API and through the command line.
+# Results are written as JSON so two runs can be compared with --compare.
+usage = """Usage:
+  python bench.py [--sizes=10000,100000] [--kinds=sorted,reverse,random] [--seed=4348]
+                  [--searches=10000] [--insert-limit=100000] [--cli-samples=50] [--no-cli]
+                  [--page-size=512] [--out=results.json] [--compare=old.json] [--keep=<dir>]"""
+
+default_sizes = [10000, 100000]
+default_kinds = ['sorted', 'reverse', 'random']
+project_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'project3.py')
+
+def write_csv(path, kind, size, seed):
+    # keys are 0..size-1 in the requested order, values are derived from the key so a run can be checked
+    keys = list(range(size))
+    if kind == 'reverse':
+        keys.reverse()
+    elif kind == 'random':
+        random.Random(seed).shuffle(keys)
+    with open(path, 'w', buffering=1 << 20) as f:
+        for k in keys:
+            f.write(f"{k},{k * 7}\n")
+    return keys
+
+def io_written():
+    # bytes this process has written so far (linux only), None anywhere else
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss #kilobytes on linux, the high water mark of this process
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def result(ops, seconds, latencies=None, bytes_written=None, block_reads=None, rss=None, file_bytes=None):
+    # one row of the report, latencies are in seconds and reported in milliseconds
+    # bytes_written is what the process wrote, file_bytes the size of the file the op left behind
+    return {
+        'ops': ops,
+        'seconds': round(seconds, 6),
+        'ops_per_sec': round(ops / seconds, 2) if seconds > 0 else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 4) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 4) if latencies else None,
+        'bytes_written': bytes_written,
+        'block_reads': block_reads,
+        'peak_rss_kb': rss,
+        'file_bytes': file_bytes,
+    }
+
+def in_child(op, *args):
+    # runs one measured op in a forked process so its peak RSS is its own and not left over from an earlier op
+    # the row comes back through a pipe as JSON with the child's peak RSS filled in
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        code = 0
+        try:
+            row = op(*args)
+            row['peak_rss_kb'] = peak_rss_kb()
+            data = json.dumps(row).encode()
+        except BaseException as e:
+            data = json.dumps({'error': repr(e)}).encode()
+            code = 1
+        with os.fdopen(w, 'wb') as f:
+            f.write(data)
+        os._exit(code)
+    os.close(w)
+    with os.fdopen(r, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    row = json.loads(data)
+    if 'error' in row:
+        raise RuntimeError(f"benchmark op failed: {row['error']}")
+    return row
+
+@contextlib.contextmanager
+def measured():
+    # collects wall time and bytes written around a block of work
+    box = {}
+    before = io_written()
+    start = time.perf_counter()
+    yield box
+    box['seconds'] = time.perf_counter() - start
+    after = io_written()
+    box['bytes_written'] = after - before if before is not None and after is not None else None
+
+def quiet_create(path, page_size):
+    with contextlib.redirect_stdout(io.StringIO()): #create() announces itself on stdout
+        BTreeFile(path).create(page_size)
+
+def api_create(idx, opts):
+    with measured() as m:
+        quiet_create(idx, opts['page_size'])
+    return result(1, m['seconds'], bytes_written=m['bytes_written'])
+
+def api_insert(idx, keys, opts):
+    # insert one row at a time, capped because this is the slow path being measured
+    quiet_create(idx, opts['page_size'])
+    tree = BTreeFile(idx)
+    latencies = []
+    with measured() as m:
+        for k in keys[:opts['insert_limit']]:
+            t0 = time.perf_counter()
+            tree.insert(k, k * 7)
+            latencies.append(time.perf_counter() - t0)
+        tree.close()
+    return result(len(latencies), m['seconds'], latencies, m['bytes_written'], tree.stats()['block_reads'])
+
+def api_load(idx, csv_path, size, opts):
+    quiet_create(idx, opts['page_size'])
+    tree = BTreeFile(idx)
+    with measured() as m:
+        tree.readFromCSV(csv_path)
+        tree.close()
+    return result(size, m['seconds'], bytes_written=m['bytes_written'], block_reads=tree.stats()['block_reads'])
+
+def api_search(idx, probes):
+    tree = BTreeFile(idx)
+    tree.readsHeader()
+    latencies = []
+    with measured() as m:
+        for k in probes:
+            t0 = time.perf_counter()
+            tree.searchKey(k)
+            latencies.append(time.perf_counter() - t0)
+    return result(len(probes), m['seconds'], latencies, m['bytes_written'], tree.stats()['block_reads'])
+
+def api_print(idx, size):
+    # the text goes to /dev/null and nothing is written to the index, so bytes_written is left empty
+    tree = BTreeFile(idx)
+    with measured() as m:
+        with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+            tree.printAll()
+    return result(size, m['seconds'], block_reads=tree.stats()['block_reads'])
+
+def api_extract(idx, dump, size):
+    # what it writes is the csv, reported as file_bytes like the commands do
+    tree = BTreeFile(idx)
+    with measured() as m:
+        tree.extractCSV(dump)
+    return result(size, m['seconds'], block_reads=tree.stats()['block_reads'], file_bytes=file_size(dump))
+
+def bench_api(workdir, csv_path, keys, opts):
+    # every op runs in a child of its own, the later ones read the index the load child left on disk
+    out = {}
+    size = len(keys)
+    rng = random.Random(opts['seed'])
+    idx = os.path.join(workdir, 'api_load.idx')
+    out['create'] = in_child(api_create, os.path.join(workdir, 'api_create.idx'), opts)
+    out['insert'] = in_child(api_insert, os.path.join(workdir, 'api_insert.idx'), keys, opts)
+    out['load'] = in_child(api_load, idx, csv_path, size, opts)
+    # lookups against the loaded index, a tenth of them for keys that are not there
+    probes = [rng.randrange(size) if rng.random() < 0.9 else size + rng.randrange(size) for _ in range(opts['searches'])]
+    out['search'] = in_child(api_search, idx, probes)
+    out['print'] = in_child(api_print, idx, size)
+    out['extract'] = in_child(api_extract, idx, os.path.join(workdir, 'api_extract.csv'), size)
+    return out
+
+def run_cli(*args):
+    # one command line invocation with --stats, gives back its wall time, the peak RSS of that process alone
+    # and the counters it printed to stderr
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, project_script] + list(args) + ['--stats'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    err = proc.stderr.read()
+    proc.stderr.close()
+    _, status, usage = os.wait4(proc.pid, 0)
+    took = time.perf_counter() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=err)
+    return took, usage.ru_maxrss, cli_stats(err)
+
+def cli_stats(err):
+    # the "stats: <name> <value>" lines of --stats, timing lines left out
+    counters = {}
+    for line in err.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == 'stats:' and parts[2].isdigit():
+            counters[parts[1]] = int(parts[2])
+    return counters
+
+def run_cli_samples(args_list):
+    # several invocations of one command, their latencies, the biggest peak RSS among them and their summed counters
+    runs = [run_cli(*args) for args in args_list]
+    counters = {}
+    for _, _, stats in runs:
+        for name, value in stats.items():
+            counters[name] = counters.get(name, 0) + value
+    return [took for took, _, _ in runs], max((rss for _, rss, _ in runs), default=None), counters
+
+def file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def cli_io(stats, opts):
+    # block_reads and the index bytes written (blocks and header pages) from a command's --stats counters
+    written = (stats.get('block_writes', 0) + stats.get('header_writes', 0)) * opts['page_size']
+    return {'block_reads': stats.get('block_reads'), 'bytes_written': written if 'block_writes' in stats else None}
+
+def bench_cli(workdir, csv_path, keys, opts):
+    # every command as its own process, the way a shell script would drive it
+    # block reads and index bytes written come from --stats, the file a command leaves is reported as file_bytes
+    out = {}
+    size = len(keys)
+    rng = random.Random(opts['seed'])
+    samples = opts['cli_samples']
+
+    idx = os.path.join(workdir, 'cli_create.idx')
+    page = f"--page-size={opts['page_size']}"
+    took, rss, _ = run_cli('create', idx, page)
+    # create writes the empty index outside the counted paths, its size is all there is to report
+    out['create'] = result(1, took, [took], rss=rss, file_bytes=file_size(idx))
+
+    latencies, rss, stats = run_cli_samples([('insert', idx, str(k), str(k * 7)) for k in keys[:samples]])
+    out['insert'] = result(len(latencies), sum(latencies), latencies, rss=rss, file_bytes=file_size(idx),
+                           **cli_io(stats, opts))
+
+    idx = os.path.join(workdir, 'cli_load.idx')
+    run_cli('create', idx, page)
+    took, rss, stats = run_cli('load', idx, csv_path)
+    out['load'] = result(size, took, rss=rss, file_bytes=file_size(idx), **cli_io(stats, opts))
+
+    latencies, rss, stats = run_cli_samples([('search', idx, str(rng.randrange(size))) for _ in range(samples)])
+    out['search'] = result(len(latencies), sum(latencies), latencies, rss=rss, **cli_io(stats, opts))
+
+    took, rss, stats = run_cli('print', idx)
+    out['print'] = result(size, took, rss=rss, **cli_io(stats, opts))
+
+    dump = os.path.join(workdir, 'cli_extract.csv')
+    took, rss, stats = run_cli('extract', idx, dump)
+    out['extract'] = result(size, took, rss=rss, file_bytes=file_size(dump), **cli_io(stats, opts))
+    return out
+
+def compare(old, new):
+    # prints ops/sec of the new run against the old one for every case both runs have
+    print(f"{'case':<44}{'old ops/s':>14}{'new ops/s':>14}{'change':>10}")
+    for case, ops in new['results'].items():
+        for op, row in ops.items():
+            before = old.get('results', {}).get(case, {}).get(op)
+            if not before or not before.get('ops_per_sec') or not row.get('ops_per_sec'):
+                continue
+            change = row['ops_per_sec'] / before['ops_per_sec'] - 1
+            print(f"{case + ' ' + op:<44}{before['ops_per_sec']:>14.1f}{row['ops_per_sec']:>14.1f}{change:>+10.1%}")
+
+def main():
+    args, raw = split_options(sys.argv[1:])
+    known = {'sizes', 'kinds', 'seed', 'searches', 'insert-limit', 'cli-samples', 'out', 'compare', 'keep', 'no-cli',
+             'page-size'}
+    if args or not set(raw) <= known:
+        print(usage, file=sys.stderr)
+        sys.exit(1)
+    opts = {
+        'sizes': [int(s) for s in str(raw.get('sizes', ','.join(map(str, default_sizes)))).split(',')],
+        'kinds': str(raw.get('kinds', ','.join(default_kinds))).split(','),
+        'seed': int_option(raw, 'seed', 4348),
+        'searches': int_option(raw, 'searches', 10000),
+        'insert_limit': int_option(raw, 'insert-limit', 100000),
+        'cli_samples': int_option(raw, 'cli-samples', 50),
+        'page_size': int_option(raw, 'page-size', project3.byte_blocks),
+    }
+    if not set(opts['kinds']) <= set(default_kinds):
+        print("Error: --kinds takes sorted, reverse and random", file=sys.stderr)
+        sys.exit(1)
+    workdir = raw.get('keep') or tempfile.mkdtemp(prefix='bench3_')
+    os.makedirs(workdir, exist_ok=True)
+    report = {
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'block_size': opts['page_size'],
+        'settings': opts,
+        'results': {},
+    }
+    try:
+        for size in opts['sizes']:
+            for kind in opts['kinds']:
+                case = f"{kind}-{size}"
+                case_dir = os.path.join(workdir, case)
+                os.makedirs(case_dir, exist_ok=True)
+                csv_path = os.path.join(case_dir, 'input.csv')
+                keys = write_csv(csv_path, kind, size, opts['seed'])
+                for mode, runner in (('api', bench_api), ('cli', bench_cli)):
+                    if mode == 'cli' and raw.get('no-cli'):
+                        continue
+                    rows = runner(case_dir, csv_path, keys, opts)
+                    report['results'][f"{mode} {case}"] = rows
+                    for op, row in rows.items():
+                        print(f"{mode} {case:<18} {op:<8} {row['ops_per_sec'] or 0:>14.1f} ops/s  "
+                              f"p50 {row['p50_ms'] if row['p50_ms'] is not None else '-'} ms  "
+                              f"p99 {row['p99_ms'] if row['p99_ms'] is not None else '-'} ms", file=sys.stderr)
+    finally:
+        if not raw.get('keep'):
+            shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if raw.get('out'):
+        with open(raw['out'], 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if raw.get('compare'):
+        with open(raw['compare']) as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
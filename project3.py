@@ -1,23 +1,141 @@
 import sys
 import os
 import struct
+import zlib
+import time
+import math
 import csv
+import io
+import heapq
+import shutil
+import tempfile
+import concurrent.futures
+import asyncio
+import contextlib
+import threading
+import mmap
+import selectors
+import signal
+import socket
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, islice
+from operator import sub, gt
 from collections import OrderedDict, deque
+try:
+    import fcntl #file locks between processes, not there on windows
+except ImportError:
+    fcntl = None
 
-# constants listed in the document
+# constants listed in the document; files made before the page size went into the header always use these
 byte_blocks = 512
 magic_number = b'4348PRJ3'  # 8 bytes ASCII
 # minimal degree
 min_degree = 10
 max_keys = 2 * min_degree - 1   # 19
 children_num = 2 * min_degree   # 20
+# create --page-size takes multiples of this, up to the largest page below
+page_unit = 512
+max_page_size = 1 << 20
+# buffer pool size when none is given, and the smallest pool allowed (a split pins 3 nodes at once)
+default_cache_pages = 256
+min_cache_pages = 8
+# the memory map grows by at least this many blocks at a time so allocating is not a remap every time
+map_grow_blocks = 256
+# search_many sorts and resolves this many keys together before answering them
+search_batch = 65536
+# check and --physical read the file front to back this many bytes at a time
+physical_read_bytes = 4 * 1024 * 1024
+# how much the server reads from a client at once, how many answer bytes a client may have waiting before the
+# server stops reading and answering its lines, and pairs fetched at a time while a range or print is answered
+serve_read_size = 65536
+serve_buffer_cap = 1 << 20
+serve_scan_chunk = 1024
+# server commands that change the tree, a batch holding any of them takes the write lock
+serve_writes = ('insert', 'delete', 'flush')
+# AsyncBTreeFile: threads doing the blocking page I/O, most puts applied under one write lock,
+# and pairs fetched per executor call while an async range scan is iterated
+async_workers = 4
+async_put_batch = 1024
+async_scan_chunk = 1024
 
 # Header layout: offset 0: 8 bytes magic, offset 8: 8 bytes root block id (0 if empty), offset 16: 8 bytes next block id
-# unused for the rest of 512 bytes
+# offset 24: 8 bytes first block of the free list (0 if none, which is what older files have there)
+# offset 32: 8 bytes change counter, bumped every time a writer holding the file lock lets go after changing something
+# offset 40: 8 bytes page size, offset 48: 8 bytes minimal degree (both 0 in older files, which means 512 and 10)
+# offset 56: 8 bytes format flags, bit 0 set when nodes use the packed layout below, bit 1 for a B+ tree
+# (0 in older files)
+# the header takes up a whole page so block n starts at n * page size, the rest of the page is unused
+
+# A freed block keeps its block id, holds the next free block id where the parent normally goes, and -1 as its pair count
+free_marker = -1
+int64_min = -(1 << 63) # keys and values are stored as signed 64 bit ints
+int64_max = (1 << 63) - 1
+
+# counters every BTreeFile keeps, reported by stats() and --stats
+stat_names = ('block_reads', 'block_writes', 'header_reads', 'header_writes', 'file_opens', 'flushes', 'fsyncs',
+              'cache_hits', 'cache_misses', 'wal_commits', 'coalesced_reads',
+              'bloom_negatives')
+
+# Write-ahead log (<indexfile>.wal): 8 bytes magic, then groups of page records, each 8 bytes block id + the
+# whole block image, closed by a commit record of 8 bytes -1, 8 bytes page count, 4 bytes crc32 of the group's records.
+# A group only counts once its commit record is complete, anything after the last good commit is ignored
+wal_magic = b'4348WAL1'
+wal_record = struct.Struct('>q') # block id in front of each page image
+wal_commit = struct.Struct('>qqI') # commit mark, pages in the group, crc32
+wal_commit_mark = -1
+wal_group_ops = 64 # inserts batched into one log append + fsync
+wal_checkpoint_bytes = 8 * 1024 * 1024 # copy the log back into the index once it gets this big
+
+# Bloom filter sidecar (<indexfile>.bloom): an 80 byte head of 8 bytes magic, 8 bytes clean flag, then the root,
+# next block, free list head and change counter of the index when the filter was saved, 8 bytes bit count,
+# 8 bytes hash count, 8 bytes keys added and 8 bytes target false positive rate in parts per million, then the bits.
+# The filter is only trusted when it was saved clean with the index in exactly that state. The clean flag is
+# cleared on disk before the first key goes in after a save, so a crash in between cannot leave it missing a key
+bloom_magic = b'4348BLM1'
+bloom_head = struct.Struct('>8s9q')
+bloom_fp_rate = 0.01
+bloom_room = 2 # a filter is sized for this many times the keys it is built from, so inserts can follow
+bloom_min_keys = 1024
+bloom_mix = 0x9E3779B97F4A7C15 # 64 bit golden ratio, spreads neighbouring keys across the filter
+
+# Binary pair files (extract/load --format=bin): a 32 byte header of 8 bytes magic, 8 bytes record count,
+# 8 bytes flags (bit 0 set when the records are in key order) and 8 unused bytes, then count records of
+# 8 byte key + 8 byte value, big endian signed like everything else
+pair_magic = b'4348PAIR'
+pair_header = struct.Struct('>8sqq8x')
+pair_sorted_flag = 1
+pair_chunk = 65536 # records read or written at a time
+
+# external sort ingest for csv files too big to sort in memory
+ingest_memory_mb = 256 # memory budget for the whole ingest when none is given
+ingest_bytes_per_csv_byte = 12 # roughly how much memory parsing and sorting takes per byte of csv text
+merge_bytes_per_record = 3 * 16 # a buffered record is held as read, as an array and as its key and value slices
 
 # Node layout: 8 bytes of their block id, 8 bytes parent's block id, 8 bytes number of pairs in this block, 152 bytes 19 keys corresponding to values in the next chuck of bytes 152 bytes of 19 values with keys in previous blocks
 # 160 bytes if 20 child pointers to the next files
 # rest unused
+# With a bigger page the layout is the same with 2t - 1 keys, 2t - 1 values and 2t children, which is 8 + 48t bytes,
+# so the degree for a page of P bytes is t = (P - 8) // 48 (10 for 512, 85 for 4096, 341 for 16384)
+
+# Packed node layout (create --packed): a 48 byte head of 8 bytes block id, 8 bytes parent, 4 bytes pair count,
+# 1 byte flags (bit 0 leaf), 1 byte each for the key, value and child widths, then 8 bytes each for the key, value
+# and child bases. After it come the n - 1 gaps between neighbouring keys, the n values minus the value base and,
+# in an internal node, the n + 1 child ids minus the child base, each run big endian at its own width of
+# 0, 1, 2, 4 or 8 bytes (0 when every entry is the same). Sorted keys that are close together take a byte or two each.
+# A packed node is split when its bytes no longer fit the page, not at a fixed key count
+packed_flag = 1
+packed_head = struct.Struct('>qqiBBBBqqq')
+packed_leaf = 1
+packed_worst = 24 #most bytes one more key, value and child can take, the degree of a packed file comes from it
+width_codes = {array(c).itemsize: c for c in 'QLIHB'} #array typecode for each run width
+
+# B+ tree files (create --bplus, bit 1 of the format flags): every pair lives in a leaf, internal nodes keep only
+# separator keys (their values are 0) and children. The separator between two children is the smallest key of the
+# right one, so keys in child i are between separators i - 1 and i, both included. A leaf keeps the block id of the
+# next leaf in its last child slot (the spare one in a packed node, where it is written in the child base)
+bplus_flag = 2
+known_flags = packed_flag | bplus_flag
 
 def int_to_bytes(n):
     return int(n).to_bytes(8, byteorder='big', signed=True) # signed = true allows negative keys to be used, but it will be converted to unsigned
@@ -25,72 +143,549 @@ def int_to_bytes(n):
 def bytes_to_int(b):
     return int.from_bytes(b, byteorder='big', signed=True) #opposite method to convert it from bytes, signed still has to be true
 
+def degree_for_page(page_size):
+    return (page_size - 8) // 48 #largest t whose node layout fits in the page
+
+def packed_degree(page_size):
+    # largest t where 2t - 1 pairs fit a packed page even at full width, so a merge can never overflow
+    return ((page_size - packed_head.size) // packed_worst + 1) // 2
+
+def byte_width(span):
+    # bytes per entry in a run whose biggest offset is span
+    if span == 0:
+        return 0
+    if span < 1 << 8:
+        return 1
+    if span < 1 << 16:
+        return 2
+    if span < 1 << 32:
+        return 4
+    return 8
+
+def run_bytes(nums, width):
+    if width == 0:
+        return b''
+    run = array(width_codes[width], nums)
+    if sys.byteorder == 'little':
+        run.byteswap() #big endian like the rest of the file
+    return run.tobytes()
+
+def read_run(data, pos, count, width):
+    run = array(width_codes[width])
+    run.frombytes(data[pos:pos + count * width])
+    if sys.byteorder == 'little':
+        run.byteswap()
+    return run
+
+class NodeFormat:
+    # everything that follows from the page size: the degree, how many keys and children fit, and the node struct
+    __slots__ = ('page_size', 'min_degree', 'max_keys', 'children_num', 'node_struct', 'zero_keys', 'zero_children',
+                 'flags', 'packed', 'bplus', 'next_slot')
+
+    def __init__(self, page_size=byte_blocks, degree=None, flags=0):
+        self.page_size = page_size
+        self.flags = flags
+        self.packed = bool(flags & packed_flag)
+        self.bplus = bool(flags & bplus_flag)
+        if self.packed:
+            # the degree only sets how empty a node may get; how full it gets is decided by its bytes, up to
+            # max_keys pairs. In memory a node starts with room for 2t pairs, which any merge or borrow fits in,
+            # and Node.reserve grows it when an insert or split needs more
+            self.min_degree = degree if degree is not None else packed_degree(page_size)
+            self.max_keys = page_size // 3
+            self.children_num = self.max_keys + 1
+            self.node_struct = None
+            self.zero_keys = bytes(16 * self.min_degree)
+            self.zero_children = bytes(8 * (2 * self.min_degree + 1))
+            self.next_slot = 2 * self.min_degree #a leaf's next leaf in a B+ tree, inside the room every node starts with
+            return
+        self.min_degree = degree if degree is not None else degree_for_page(page_size)
+        self.max_keys = 2 * self.min_degree - 1
+        self.children_num = 2 * self.min_degree
+        # the whole node layout above, big endian
+        self.node_struct = struct.Struct(f'>3q{self.max_keys}q{self.max_keys}q{self.children_num}q')
+        self.zero_keys = bytes(8 * self.max_keys) #raw zeros used to start empty key/value arrays
+        self.zero_children = bytes(8 * self.children_num)
+        self.next_slot = self.children_num - 1 #a leaf never has children, its last slot holds the next leaf in a B+ tree
+
+    def fits(self):
+        if self.packed:
+            t = self.min_degree
+            return t >= 2 and 2 * t - 1 <= self.max_keys and packed_head.size + packed_worst * (2 * t - 1) <= self.page_size
+        return self.min_degree >= 2 and self.node_struct.size <= self.page_size
+
+default_format = NodeFormat(byte_blocks, min_degree) #the 512 byte layout older files have
+
 class Node:
     #read node layout for what will we do with this
-    def __init__(self, block_id=0): #initializes it, assume it is 0 at first
+    __slots__ = ('block_id', 'parent', 'n', 'keys', 'values', 'children', 'fmt') #no per-node dict, nodes stay small in the pool
+
+    def __init__(self, block_id=0, fmt=default_format): #initializes it, assume it is 0 at first
         self.block_id = block_id # if a parameter is passed, we will make it
         self.parent = 0 #assume nothing at first
         self.n = 0 # number of keys currently in there
-        self.keys = [0] * max_keys # the 19 keys associated with it
-        self.values = [0] * max_keys #the 19 values associated with it
-        self.children = [0] * children_num #list of potential children, currently 0
+        self.fmt = fmt #page size and degree of the file this node belongs to
+        self.keys = array('q', fmt.zero_keys) # the 19 keys associated with it (2t - 1 with bigger pages)
+        self.values = array('q', fmt.zero_keys) #the 19 values associated with it
+        self.children = array('q', fmt.zero_children) #list of potential children, currently 0
 
     def is_leaf(self):
-        return all(cid == 0 for cid in self.children) #If all the children are 0, then it is a leaf node
+        return self.children[0] == 0 #a leaf has no children, an internal node always has a first one
+
+    def reserve(self, count):
+        # room for count pairs and count + 1 children; only a packed node can start with less
+        short = count - len(self.keys)
+        if short > 0:
+            self.keys.frombytes(bytes(8 * short))
+            self.values.frombytes(bytes(8 * short))
+        short = count + 1 - len(self.children)
+        if short > 0:
+            self.children.frombytes(bytes(8 * short))
 
     def to_bytes(self):
-        bytebuffer = bytearray() # create a mutable byte buffer to assemble the block
-        bytebuffer += int_to_bytes(self.block_id) #appending the 8 bytes for the header (big endian)
-        bytebuffer += int_to_bytes(self.parent) #appends the 8 bytes for the parent of this node (will be 0 if root)
-        bytebuffer += int_to_bytes(self.n) #appends the 8 bytes for the number of keys that will be used
-        # keys
-        for i in range(max_keys): #loop through all keys
-            bytebuffer += int_to_bytes(self.keys[i]) #appends every 8 bytes for the keys associated in this part of the node
-        # values
-        for i in range(max_keys): #loop through all the keys
-            bytebuffer += int_to_bytes(self.values[i]) # appends every 8 bytes and puts the values into it
-        # children
-        for i in range(children_num): #loop through the children number
-            bytebuffer += int_to_bytes(self.children[i]) #puts in the children block ids for the pointers
-        # pad to byte_blocks
-        if len(bytebuffer) > byte_blocks: #make sure we don't accidentally go over the block size
-            raise RuntimeError("Node serialization exceeded block size")
-        bytebuffer += bytes(byte_blocks - len(bytebuffer))
+        if self.fmt.packed:
+            return self.to_packed()
+        bytebuffer = bytearray(self.fmt.page_size) # whole block, the unused tail stays zero
+        # one precompiled pack for all the numbers: block id, parent, n, keys, values, children
+        self.fmt.node_struct.pack_into(bytebuffer, 0, self.block_id, self.parent, self.n,
+                                       *self.keys, *self.values, *self.children)
         return bytes(bytebuffer)
 
     @staticmethod
-    def from_bytes(data):
-        if len(data) != byte_blocks:  # Makes sure we get the right block length
+    def from_bytes(data, offset=0, fmt=default_format):
+        if len(data) - offset < fmt.page_size:  # Makes sure we get the right block length
             raise ValueError("Invalid block size for node")
-        offset = 0 #read the offset, starts at 0 and increments
-        def read8bytes():
-            nonlocal offset
-            val = bytes_to_int(data[offset:offset+8]) # read 8 bytes from current offset and converts it to and integer, reads from 0-8
-            offset += 8 #increments the offset
-            return val #return the value here
-        node = Node() #creates a new node
-        node.block_id = read8bytes() #reads the first 8 bytes, will get the block_id
-        node.parent = read8bytes() # parent block id from the next 8 bytes
-        node.n = read8bytes() #reads the numbers of keys from the next 8 bytes that are in n
-        # keys
-        for i in range(max_keys): #in each key slot
-            node.keys[i] = read8bytes() #read the 8bytes and put it in the list of keys
-        # values
-        for i in range(max_keys): # for each max key value
-            node.values[i] = read8bytes() # read the 8bytes and put in the list of values
-        # children
-        for i in range(children_num): #for each child id
-            node.children[i] = read8bytes() #read the 8 bytes and store it into the list of children (0 in all slots means its a leaf node)
+        if fmt.packed:
+            return Node.from_packed(data, offset, fmt)
+        fields = fmt.node_struct.unpack_from(data, offset) #reads a memoryview or the memory map in place, no copy first
+        node = Node.__new__(Node) #skip __init__, every slot is filled below
+        node.block_id, node.parent, node.n = fields[0], fields[1], fields[2]
+        node.fmt = fmt
+        mk = fmt.max_keys
+        node.keys = array('q', fields[3:3 + mk])
+        node.values = array('q', fields[3 + mk:3 + 2 * mk])
+        node.children = array('q', fields[3 + 2 * mk:]) #0 in all slots means its a leaf node
         return node #return the list now filled with the node values
 
+    # packed layout
+    def packed_size(self):
+        # bytes this node takes in the packed layout, worked out without building them
+        n = self.n
+        if n <= 0:
+            return packed_head.size #a free block, or a new root that only has its first child so far
+        keys = self.keys
+        kw = byte_width(max(map(sub, keys[1:n], keys[:n - 1]), default=0))
+        values = self.values[:n]
+        size = packed_head.size + (n - 1) * kw + n * byte_width(max(values) - min(values))
+        if not self.is_leaf():
+            children = self.children[:n + 1]
+            size += (n + 1) * byte_width(max(children) - min(children))
+        return size
+
+    def to_packed(self):
+        n = self.n
+        page = self.fmt.page_size
+        if n < 0: #free block, only the head matters
+            return packed_head.pack(self.block_id, self.parent, n, packed_leaf, 0, 0, 0, 0, 0, 0) + bytes(page - packed_head.size)
+        leaf = self.is_leaf()
+        keys = self.keys[:n]
+        gaps = list(map(sub, keys[1:], keys[:-1]))
+        kw = byte_width(max(gaps, default=0))
+        values = self.values[:n]
+        vbase = min(values, default=0)
+        vw = byte_width(max(values, default=0) - vbase)
+        children = self.children[:0 if leaf else n + 1]
+        cbase = self.children[self.fmt.next_slot] if leaf else min(children) #a leaf has no child run, its base is the next leaf
+        cw = byte_width(max(children, default=0) - cbase)
+        buf = bytearray(packed_head.pack(self.block_id, self.parent, n, packed_leaf if leaf else 0, kw, vw, cw,
+                                         keys[0] if n else 0, vbase, cbase))
+        buf += run_bytes(gaps, kw)
+        buf += run_bytes(map(vbase.__rsub__, values), vw)
+        buf += run_bytes(map(cbase.__rsub__, children), cw)
+        if len(buf) > page:
+            raise RuntimeError(f"Packed node {self.block_id} does not fit its page")
+        buf += bytes(page - len(buf))
+        return bytes(buf)
+
+    @staticmethod
+    def from_packed(data, offset, fmt):
+        bid, parent, n, flags, kw, vw, cw, kbase, vbase, cbase = packed_head.unpack_from(data, offset)
+        node = PackedNode.__new__(PackedNode)
+        node.block_id, node.parent, node.n, node.fmt = bid, parent, n, fmt
+        m = max(n, 0)
+        pos = offset + packed_head.size
+        # only the key run is decoded here, it adds its gaps back up from the base in one C level conversion
+        if m == 0:
+            keys = array('q')
+        else:
+            keys = array('q', accumulate(read_run(data, pos, m - 1, kw), initial=kbase)) if kw else array('q', [kbase]) * m
+            pos += (m - 1) * kw
+        keys.frombytes(fmt.zero_keys[8 * m:]) #room for 2t pairs like a new node
+        node.keys = keys
+        node.leaf = bool(flags & packed_leaf)
+        # the value and child runs are copied out as they are and decoded the first time they are used
+        end = pos + m * vw + (0 if node.leaf else (m + 1) * cw)
+        raw = bytes(data[pos:end])
+        node.pending_values = (raw, m, vw, vbase)
+        node.pending_children = (raw, m, m * vw, cw, cbase)
+        return node
+
+class PackedNode(Node):
+    # a node read from a packed page; values and children are decoded when something first asks for them,
+    # so a search through a node that only looks at its keys never pays for them
+    __slots__ = ('leaf', 'pending_values', 'pending_children')
+
+    def is_leaf(self):
+        if self.pending_children is not None:
+            return self.leaf
+        return self.children[0] == 0
+
+    @property
+    def values(self):
+        if self.pending_values is not None:
+            raw, m, vw, vbase = self.pending_values
+            values = array('q', map(vbase.__add__, read_run(raw, 0, m, vw))) if vw else array('q', [vbase]) * m
+            values.frombytes(bytes(8 * (len(self.keys) - m)))
+            self.values = values
+        return Node.values.__get__(self)
+
+    @values.setter
+    def values(self, run):
+        self.pending_values = None
+        Node.values.__set__(self, run)
+
+    @property
+    def children(self):
+        if self.pending_children is not None:
+            raw, m, pos, cw, cbase = self.pending_children
+            if self.leaf:
+                children = array('q') #no child run, the base is the next leaf
+            else:
+                children = array('q', map(cbase.__add__, read_run(raw, pos, m + 1, cw))) if cw else array('q', [cbase]) * (m + 1)
+            children.frombytes(bytes(8 * (len(self.keys) + 1 - len(children))))
+            if self.leaf:
+                children[self.fmt.next_slot] = cbase
+            self.children = children
+        return Node.children.__get__(self)
+
+    @children.setter
+    def children(self, run):
+        self.pending_children = None
+        Node.children.__set__(self, run)
+
+class BufferPool:
+    # LRU pool of nodes in memory. A changed node is only marked dirty, and it is written back
+    # when it gets evicted or the pool is flushed, so clean nodes never get written again
+    def __init__(self, capacity, write_back):
+        self.capacity = max(capacity, min_cache_pages) #how many nodes can stay in memory
+        self.write_back = write_back #called with a dirty node that has to go to disk
+        self.frames = OrderedDict() #block id -> node, least recently used first
+        self.dirty = set() #block ids changed since they were last written
+        self.pins = {} #block id -> pin count, pinned nodes are never evicted
+        self.evictions = 0 #nodes pushed out to make room
+        self.write_backs = 0 #dirty nodes written, on eviction or flush
+
+    def __contains__(self, block_id):
+        return block_id in self.frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get(self, block_id):
+        node = self.frames.get(block_id)
+        if node is not None:
+            self.frames.move_to_end(block_id) #mark it as the most recent
+        return node
+
+    def put(self, node, dirty=False):
+        bid = node.block_id
+        self.frames[bid] = node
+        self.frames.move_to_end(bid)
+        if dirty:
+            self.dirty.add(bid)
+        self._evict()
+
+    def pin(self, block_id):
+        self.pins[block_id] = self.pins.get(block_id, 0) + 1
+
+    def unpin(self, block_id):
+        count = self.pins.get(block_id, 0) - 1
+        if count > 0:
+            self.pins[block_id] = count
+        else:
+            self.pins.pop(block_id, None)
+            self._evict() #it may have been kept over capacity while it was pinned
+
+    def _evict(self):
+        while len(self.frames) > self.capacity:
+            victim = next((bid for bid in self.frames if bid not in self.pins), None) #oldest unpinned node
+            if victim is None:
+                return #everything is pinned, stay over capacity until something is unpinned
+            node = self.frames.pop(victim)
+            self.evictions += 1
+            if victim in self.dirty:
+                self.dirty.discard(victim)
+                self.write_backs += 1
+                self.write_back(node) #only dirty nodes get written back
+
+    def clear(self):
+        # forgets every node, only called when nothing is dirty
+        self.frames.clear()
+        self.dirty.clear()
+
+    def flush(self):
+        for bid in sorted(self.dirty): #block order, so the writes go through the file front to back
+            self.write_backs += 1
+            self.write_back(self.frames[bid])
+        self.dirty.clear()
+
+class BloomFilter:
+    # bits that say a key is certainly not in the tree; a key that was added always tests positive
+    # the k bit positions come from one 64 bit mix of the key split into two halves (double hashing)
+    def __init__(self, path, bits, hashes, fp_rate, count=0, data=None):
+        self.path = path
+        self.bits = bits
+        self.hashes = hashes
+        self.fp_rate = fp_rate #what it was sized for
+        self.count = count #keys added, deleted keys are never taken back out
+        self.data = data if data is not None else bytearray((bits + 7) // 8)
+        self.changed = set() #byte offsets set since the last save
+        self.rewrite = data is None #a new filter is written out whole
+        self.clean = False #the file on disk is marked clean and matches these bits
+        self.stamp = None #index state the file was last saved with
+
+    @staticmethod
+    def sized(path, keys, fp_rate=bloom_fp_rate):
+        n = max(keys * bloom_room, bloom_min_keys)
+        bits = max(64, math.ceil(-n * math.log(fp_rate) / math.log(2) ** 2))
+        hashes = max(1, round(bits / n * math.log(2)))
+        return BloomFilter(path, bits, hashes, fp_rate)
+
+    def _positions(self, key):
+        h = (key * bloom_mix) & 0xFFFFFFFFFFFFFFFF
+        h ^= h >> 29
+        h = (h * bloom_mix) & 0xFFFFFFFFFFFFFFFF
+        a, b = h >> 32, (h & 0xFFFFFFFF) | 1
+        return [(a + i * b) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        data = self.data
+        return all(data[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        if self.clean:
+            self._mark(0) #from now on the file is behind the tree until the next save
+        data = self.data
+        for p in self._positions(key):
+            data[p >> 3] |= 1 << (p & 7)
+            self.changed.add(p >> 3)
+        self.count += 1
+
+    def adding(self, pairs):
+        # passes (key, value) pairs through, adding every key on the way
+        for pair in pairs:
+            self.add(pair[0])
+            yield pair
+
+    def estimated_fp(self):
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    def _head(self, clean, stamp):
+        return bloom_head.pack(bloom_magic, clean, *stamp, self.bits, self.hashes, self.count,
+                               round(self.fp_rate * 1000000))
+
+    def _mark(self, clean):
+        with open(self.path, 'r+b') as f:
+            f.seek(8)
+            f.write(int_to_bytes(clean))
+        self.clean = bool(clean)
+
+    def save(self, stamp):
+        # writes what changed, then the head marked clean with the index state it matches
+        if self.rewrite or len(self.changed) * 64 > len(self.data): #many scattered bytes, one write is cheaper
+            with open(self.path, 'wb') as f:
+                f.write(self._head(0, stamp))
+                f.write(self.data)
+        else:
+            with open(self.path, 'r+b') as f:
+                for i in sorted(self.changed):
+                    f.seek(bloom_head.size + i)
+                    f.write(self.data[i:i + 1])
+        with open(self.path, 'r+b') as f:
+            f.write(self._head(1, stamp))
+        self.changed.clear()
+        self.rewrite = False
+        self.clean = True
+        self.stamp = stamp
+
+    @staticmethod
+    def load(path):
+        # gives back (filter, clean flag, index state it was saved with)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < bloom_head.size or data[:8] != bloom_magic:
+            raise ValueError("Not a valid bloom filter file")
+        magic, clean, root, next_block, free_head, change, bits, hashes, count, fp_ppm = bloom_head.unpack_from(data)
+        if len(data) - bloom_head.size != (bits + 7) // 8 or hashes < 1:
+            raise ValueError("Bloom filter file is cut short")
+        bloom = BloomFilter(path, bits, hashes, fp_ppm / 1000000, count, bytearray(data[bloom_head.size:]))
+        bloom.clean = bool(clean)
+        bloom.stamp = (root, next_block, free_head, change)
+        return bloom, bloom.clean, bloom.stamp
+
+class RWLock:
+    # many readers or one writer among the threads of one process, a writer that is waiting holds off new readers
+    # the thread holding the write side can take either side again and a reader can read again without waiting,
+    # but a reader cannot turn into a writer. first_in(exclusive) runs when the process goes from no holders to
+    # some and last_out(exclusive) when it goes back, that is where the file lock between processes is taken
+    def __init__(self, first_in, last_out):
+        self.cond = threading.Condition()
+        self.readers = 0 #read holds across all threads, nested ones included
+        self.writer = None #thread holding the write side
+        self.write_depth = 0
+        self.waiting_writers = 0
+        self.mine = threading.local() #read depth of the current thread
+        self.first_in = first_in
+        self.last_out = last_out
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self.cond:
+            depth = getattr(self.mine, 'depth', 0)
+            if self.writer != me and depth == 0:
+                while self.writer is not None or self.waiting_writers:
+                    self.cond.wait()
+                if self.readers == 0:
+                    self.first_in(False)
+            self.readers += 1
+            self.mine.depth = depth + 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            self.mine.depth -= 1
+            if self.readers == 0 and self.writer is None:
+                try:
+                    self.last_out(False)
+                finally:
+                    self.cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.write_depth += 1
+                return
+            if getattr(self.mine, 'depth', 0):
+                raise RuntimeError("Cannot take the write lock while holding the read lock")
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.write_depth = 1
+            try:
+                self.first_in(True)
+            except BaseException:
+                self.writer = None
+                self.write_depth = 0
+                self.cond.notify_all()
+                raise
+
+    def release_write(self):
+        with self.cond:
+            if self.write_depth > 1:
+                self.write_depth -= 1
+                return
+            try:
+                self.last_out(True) #still counted as held, so a flush in here can take the lock again
+            finally:
+                self.writer = None
+                self.write_depth = 0
+                self.cond.notify_all()
+
 class BTreeFile:
-    def __init__(self, path):
+    def __init__(self, path, cache_pages=None, cache_mb=None, use_mmap=False, wal=False, wal_group=wal_group_ops,
+                 pin_internal=False, timing_hook=None, time_calls=False, lock_file=False):
         self.path = path # we need to keep the path available to write
         # openInrw() will make it writable to, not just readable.
         self.fp = None  #There might be none if there is nothing to handle too
         self.root = 0 # block id of the B-tree root node. if it is 0, then it's empty.
         self.next_block = 1  #block id of the next unused block; the first allocated data block is 1 after the header
-        self.node_cache = OrderedDict() # OrderedDict mapping block_id is the node. Keeps the most recent at the end
+        self.free_head = 0 #first block on the free list, 0 when nothing has been freed
+        self.fmt = default_format #replaced by the file's own page size and degree when the header is read
+        self.cache_mb = cache_mb #a pool sized in megabytes is sized again once the page size is known
+        if cache_pages is None:
+            cache_pages = cache_mb * 1024 * 1024 // byte_blocks if cache_mb is not None else default_cache_pages
+        self.pool = BufferPool(cache_pages, self._write_node_to_disk) #nodes in memory, dirty ones written back later
+        self.held = [] #block ids a delete has pinned, every node it touches stays pinned until it is done
+        self.use_mmap = use_mmap #read and write blocks through a memory map instead of file calls
+        self.mm = None #the map itself, made the first time a block is touched
+        self.map_fp = None #handle the map was made from
+        self.mm_writable = False #whether the map was opened for writing, set with the map
+        self.wal = wal #log page images to the .wal sidecar and commit them in groups
+        self.wal_group = max(1, wal_group) #operations per group commit
+        self.wal_fp = None #append handle on the log
+        self.wal_pages = {} #block id -> newest image not yet copied back into the index file
+        self.wal_pending = {} #block id -> image written since the last commit
+        self.wal_ops = 0 #operations since the last commit
+        self.wal_checked = False #recovery runs once, the first time the header is read
+        self.wal_end = None #where the last fully committed group in the log ends, new groups are appended there
+        self.pin_internal = pin_internal #keep every internal node in memory so a lookup reads at most one leaf
+        self.inner = None #block id -> (keys, values, children) of each internal node, loaded with the header
+        self.counters = dict.fromkeys(stat_names, 0) #what the I/O and cache paths have done so far
+        self.timing_hook = timing_hook #called as timing_hook(name, seconds) after every timed call
+        self.timings = {} if time_calls else None #name -> [calls, total seconds], kept when time_calls is on
+        self.timed = timing_hook is not None or time_calls #checked first so untimed runs skip the clock
+        self.lock_file = lock_file and fcntl is not None #share the file with other processes through fcntl locks
+        self.lock_fp = None #handle the file lock is held on
+        self.file_lock = None #fcntl.LOCK_SH or LOCK_EX while this process holds the file
+        self.file_stamp = None #what the file looked like when this process last let go of it
+        self.change_count = 0 #header change counter, see the layout above
+        self.wrote = False #a block was written since the write lock was taken
+        self.rw = RWLock(self._lock_in, self._lock_out) #readers share, one writer at a time
+        self.mutex = threading.RLock() #guards the buffer pool and counters between reader threads
+        self.loading = {} #block id -> Event for a block one thread is reading, so the others wait instead of reading it too
+        self.read_fd = None #one read only descriptor, os.pread lets every thread use it at once
+        self.bloom = None #the .bloom sidecar when there is one that matches the index
+        self.bloom_checked = False #looked for the sidecar once, when the header is first read
+        self.bloom_stale = False #there is a sidecar but it does not match, it needs a rebuild
+        self.session = None #'r' or 'rw' while opened with BTreeFile.open, fp is then the one descriptor for the file
+        self.header_dirty = False #a session keeps header changes in memory until the next flush or close
+
+    # sessions: with BTreeFile.open(path) as t, the header is checked once and one descriptor stays open
+    @classmethod
+    def open(cls, path, mode='rw', **options):
+        # options are the same as for BTreeFile(); raises for a missing or bad file instead of exiting
+        if mode not in ('r', 'rw'):
+            raise ValueError("mode must be 'r' or 'rw'")
+        return cls(path, **options)._open_session(mode)
+
+    def _open_session(self, mode):
+        self.fp = open(self.path, 'r+b' if mode == 'rw' else 'rb') #every read and write of blocks and the header uses it
+        self.counters['file_opens'] += 1
+        self.session = mode
+        self.read_fd = self.fp.fileno()
+        try:
+            with self.reading(): #a locked file is read by the first lock, which also records what it looked like
+                if not self.lock_file:
+                    self.readsHeader() #the only time it is validated, it stays in memory after this
+        except Exception:
+            self.fp.close()
+            self.fp = self.read_fd = self.session = None
+            if self.lock_fp is not None:
+                self.lock_fp.close()
+                self.lock_fp = None
+            raise
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     # simple file operations
     def openInrw(self):
@@ -104,17 +699,409 @@ class BTreeFile:
         # 'r+b' requires the file already exists, so it will either be created or not open
         # the above checks if we can open it in read/write in binary mode
         self.fp = open(self.path, 'r+b')#open the file path in read and write mode
+        self.counters['file_opens'] += 1
 
     def openInro(self): #read only opening
         return open(self.path, 'rb') #simply opens it only in read only mode
 
+    def flush(self):
+        # the commit point of a session: the nodes and then the header it has kept in memory
+        with self.writing():
+            if self.wal:
+                self.commit() #dirty nodes go into the log, one append and fsync
+            else:
+                self.pool.flush() #write back every dirty node
+                self._flush_header()
+                if self.mm is not None and self.mm_writable:
+                    self.mm.flush() #push the mapped pages out to the file
+                    self.counters['flushes'] += 1
+            self._save_bloom() #only once the tree it describes is written
+
     def close(self):
-        if self.fp:
-            self.fp.close()
-            self.fp = None
+        # also ends a session, the tree can still be used afterwards but opens the file as it needs it again
+        with self.reading() if self.session == 'r' else self.writing():
+            if self.session != 'r': #a read only session has nothing to write back
+                self.flush()
+                if self.wal:
+                    self.checkpoint() #everything back into the index, the log is not needed after a clean close
+            if self.read_fd is not None and self.session is None:
+                os.close(self.read_fd)
+            self.read_fd = None
+            if self.fp:
+                self.fp.close()
+                self.fp = None
+            self.session = None
+            self._close_map()
+        if self.lock_fp is not None and self.rw.writer is None and not self.rw.readers:
+            self.lock_fp.close()
+            self.lock_fp = None
+
+    # locking: threads share a reader/writer lock, processes share an fcntl lock on the index file
+    @contextlib.contextmanager
+    def reading(self):
+        self.rw.acquire_read()
+        try:
+            yield
+        finally:
+            self.rw.release_read()
+
+    @contextlib.contextmanager
+    def writing(self):
+        if self.session == 'r':
+            raise io.UnsupportedOperation(f"{self.path} was opened read only")
+        self.rw.acquire_write()
+        try:
+            yield
+        finally:
+            self.rw.release_write()
+
+    def _lock_in(self, exclusive):
+        # the first holder in this process locks the file; if another process changed it since, drop the cache
+        if not self.lock_file:
+            return
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        while True:
+            if self.lock_fp is None:
+                self.lock_fp = open(self.path, 'r+b' if os.access(self.path, os.W_OK) else 'rb')
+                self.counters['file_opens'] += 1
+            fd = self.lock_fp.fileno()
+            # flock lets new readers in ahead of a waiting writer, so everyone first passes a one byte fcntl gate
+            # that a waiting writer keeps shut; it is only held while the flock is being taken
+            gated = not exclusive or self.lock_fp.mode != 'rb' #shutting the gate needs write access
+            if gated:
+                fcntl.lockf(fd, mode, 1, 0)
+            try:
+                fcntl.flock(fd, mode)
+            finally:
+                if gated:
+                    fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+            if os.fstat(self.lock_fp.fileno()).st_ino == os.stat(self.path).st_ino:
+                break
+            # a vacuum swapped in a new file while we waited, the lock has to be on that one
+            fcntl.flock(self.lock_fp.fileno(), fcntl.LOCK_UN)
+            self.lock_fp.close()
+            self.lock_fp = None
+        self.file_lock = mode
+        if self._file_stamp() != self.file_stamp:
+            try:
+                self._reload()
+            except BaseException:
+                fcntl.flock(self.lock_fp.fileno(), fcntl.LOCK_UN) #a bad header, nobody holds the file after all
+                self.file_lock = None
+                raise
+        if exclusive and self.wal_pages and not self.wal:
+            self.checkpoint() #pages a shared lock replayed from a crashed log, the file needs them before it changes
+
+    def _lock_out(self, exclusive):
+        # the last holder in this process lets go of the file, a writer leaves everything on disk first
+        if not self.lock_file:
+            return
+        try:
+            if exclusive:
+                if self.wrote or self.pool.dirty or self.wal_pending:
+                    self.change_count += 1 #tells the other processes their cached nodes are stale
+                    self.writesHeader()
+                if self.wal:
+                    self.commit() #the other processes read committed pages out of the log
+                else:
+                    self.pool.flush() #into the file or the shared map, either way the page cache has it for everyone
+                    self._flush_header()
+                self._save_bloom()
+                if self.wal_fp is not None:
+                    self.wal_fp.close() #another process may checkpoint and remove the log before we write again
+                    self.wal_fp = None
+                self.wrote = False
+            self.file_stamp = self._file_stamp()
+        finally:
+            fcntl.flock(self.lock_fp.fileno(), fcntl.LOCK_UN)
+            self.file_lock = None
+
+    def _file_stamp(self):
+        # which file, its change counter and the size and time of the log; any difference means someone wrote
+        fd = self.lock_fp.fileno()
+        stamp = (os.fstat(fd).st_ino, bytes_to_int(os.pread(fd, 8, 32).rjust(8, b'\0')))
+        try:
+            st = os.stat(self._wal_path())
+            stamp += (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        return stamp
+
+    def _reload(self):
+        # nothing is dirty between lock holds, so everything read from the file can simply be forgotten
+        self.pool.clear()
+        self.inner = None
+        self.wal_pages.clear()
+        self.wal_checked = False
+        self.bloom = None #another process may have added keys to it
+        self.bloom_checked = False
+        if self.session is not None:
+            if os.fstat(self.fp.fileno()).st_ino != os.stat(self.path).st_ino: #a vacuum swapped in a new file
+                self.fp.close()
+                self.fp = open(self.path, 'r+b' if self.session == 'rw' else 'rb')
+                self.counters['file_opens'] += 1
+                self.read_fd = self.fp.fileno()
+        elif self.read_fd is not None:
+            os.close(self.read_fd)
+            self.read_fd = None
+        if self.mm is not None:
+            self._close_map(trim=False) #our next_block may be old, leave the file length alone
+        self.readsHeader()
+
+    # bloom filter sidecar
+    def _bloom_path(self):
+        return self.path + '.bloom'
+
+    def _bloom_stamp(self):
+        return (self.root, self.next_block, self.free_head, self.change_count)
+
+    def _load_bloom(self):
+        self.bloom_checked = True
+        self.bloom = None
+        self.bloom_stale = False
+        if not os.path.exists(self._bloom_path()):
+            return
+        try:
+            bloom, clean, stamp = BloomFilter.load(self._bloom_path())
+        except ValueError:
+            self.bloom_stale = True
+            return
+        if clean and stamp == self._bloom_stamp():
+            self.bloom = bloom
+            return
+        # the index changed without the filter (or it crashed halfway), never trust it again until a rebuild
+        self.bloom_stale = True
+        if clean and os.access(self._bloom_path(), os.W_OK):
+            bloom._mark(0)
+
+    def _save_bloom(self):
+        # after the tree is on disk; a delete or split that only moved the header still needs the new stamp
+        bloom = self.bloom
+        if bloom is not None and (not bloom.clean or bloom.changed or bloom.rewrite or bloom.stamp != self._bloom_stamp()):
+            bloom.save(self._bloom_stamp())
+
+    def build_bloom(self, fp_rate=bloom_fp_rate, incoming=0):
+        # (re)builds the .bloom sidecar from every key in the tree, sized for bloom_room times as many keys
+        # plus the incoming keys a load is about to add
+        self.openAndLoadHeader()
+        with self.writing():
+            count = sum(1 for _ in self._scan(None, None))
+            self.bloom = BloomFilter.sized(self._bloom_path(), count + incoming, fp_rate)
+            for k, _ in self._scan(None, None):
+                self.bloom.add(k)
+            self.bloom_stale = False
+            self.bloom.save(self._bloom_stamp())
+
+    # write-ahead log
+    def _wal_path(self):
+        return self.path + '.wal'
+
+    def _end_op(self):
+        # called after every finished insert, commits the group once it is big enough
+        if self.wal:
+            self.wal_ops += 1
+            if self.wal_ops >= self.wal_group:
+                self.commit()
+
+    def commit(self):
+        # appends every page changed since the last commit as one group, then one fsync makes the group durable
+        self.pool.flush() #dirty nodes become pending page images
+        self._flush_header() #goes into the same group as the blocks it points at
+        self.wal_ops = 0
+        if not self.wal_pending:
+            return
+        buf = bytearray()
+        crc = 0
+        for bid in sorted(self.wal_pending):
+            record = wal_record.pack(bid) + self.wal_pending[bid]
+            crc = zlib.crc32(record, crc)
+            buf += record
+        buf += wal_commit.pack(wal_commit_mark, len(self.wal_pending), crc)
+        if self.wal_fp is None:
+            self.wal_fp = open(self._wal_path(), 'ab')
+            self.counters['file_opens'] += 1
+            if self.wal_end is not None and self.wal_fp.tell() > self.wal_end:
+                self.wal_fp.truncate(self.wal_end) #cut off a torn group, a replay would stop there and miss ours
+                self.wal_fp.seek(self.wal_end)
+            if self.wal_fp.tell() == 0:
+                self.wal_fp.write(wal_magic) #new log
+        self.wal_fp.write(buf)
+        self.wal_fp.flush()
+        os.fsync(self.wal_fp.fileno())
+        self.counters['wal_commits'] += 1
+        self.counters['flushes'] += 1
+        self.counters['fsyncs'] += 1
+        self.wal_pending.clear()
+        self.wal_end = self.wal_fp.tell()
+        if self.wal_fp.tell() >= wal_checkpoint_bytes:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # copies the committed pages into the index file, syncs it, then empties the log
+        if self.wal_pending:
+            self.commit()
+        if self.wal_pages and self.use_mmap:
+            for bid in sorted(self.wal_pages): #front to back through the file
+                self._put_block(bid, self.wal_pages[bid])
+            self.mm.flush()
+            self.counters['flushes'] += 1
+        elif self.wal_pages and self.session is not None:
+            for bid in sorted(self.wal_pages):
+                os.pwrite(self.fp.fileno(), self.wal_pages[bid], self._block_offset(bid))
+            os.fsync(self.fp.fileno())
+            self.counters['flushes'] += 1
+            self.counters['fsyncs'] += 1
+        elif self.wal_pages:
+            with open(self.path, 'r+b') as f: #one handle for the whole checkpoint
+                self.counters['file_opens'] += 1
+                for bid in sorted(self.wal_pages):
+                    f.seek(self._block_offset(bid))
+                    f.write(self.wal_pages[bid])
+                f.flush()
+                os.fsync(f.fileno())
+                self.counters['flushes'] += 1
+                self.counters['fsyncs'] += 1
+        self.wal_pages.clear()
+        if self.wal_fp is not None:
+            self.wal_fp.close()
+            self.wal_fp = None
+        if os.path.exists(self._wal_path()):
+            os.remove(self._wal_path()) #only after the index itself is synced
+        self.wal_end = None
+
+    @staticmethod
+    def _parse_wal(data, page_size=byte_blocks):
+        # block id -> image for every page in a fully committed group, later groups win,
+        # and the offset just past the last of those groups
+        pages = {}
+        if data[:len(wal_magic)] != wal_magic:
+            return pages, 0
+        pos = end = len(wal_magic)
+        group = {}
+        crc = 0
+        record_size = wal_record.size + page_size
+        while pos + wal_record.size <= len(data):
+            bid = wal_record.unpack_from(data, pos)[0]
+            if bid == wal_commit_mark:
+                if pos + wal_commit.size > len(data):
+                    break #commit record cut off by a crash
+                _, count, want = wal_commit.unpack_from(data, pos)
+                if count != len(group) or want != crc:
+                    break #torn or corrupt group
+                pages.update(group)
+                group = {}
+                crc = 0
+                pos += wal_commit.size
+                end = pos
+                continue
+            if bid < 0 or pos + record_size > len(data):
+                break
+            crc = zlib.crc32(data[pos:pos + record_size], crc)
+            group[bid] = bytes(data[pos + wal_record.size:pos + record_size])
+            pos += record_size
+        return pages, end
+
+    def _recover_wal(self):
+        # replays a log left behind by a crash; without write access the pages are only used for reading
+        # True when the pages were copied into the index file, so the header there is the new one
+        self.wal_checked = True
+        if not os.path.exists(self._wal_path()):
+            return False
+        with open(self._wal_path(), 'rb') as f:
+            self.counters['file_opens'] += 1
+            pages, self.wal_end = self._parse_wal(f.read(), self.fmt.page_size)
+            self.wal_pages.update(pages)
+        if os.access(self.path, os.W_OK) and self.session != 'r' and (not self.lock_file or self.file_lock == fcntl.LOCK_EX):
+            self.checkpoint() #only a writer holding the file may rewrite it
+            return True
+        return False
+
+    # memory mapped mode
+    def _open_map(self):
+        self.mm_writable = os.access(self.path, os.W_OK) and self.session != 'r'
+        self.map_fp = open(self.path, 'r+b' if self.mm_writable else 'rb')
+        self.counters['file_opens'] += 1
+        access = mmap.ACCESS_WRITE if self.mm_writable else mmap.ACCESS_READ
+        self.mm = mmap.mmap(self.map_fp.fileno(), 0, access=access)
+
+    def _grow_map(self, size):
+        # makes the map (and the file under it) at least size bytes, with some room to spare
+        if size <= len(self.mm):
+            return
+        on_disk = os.fstat(self.map_fp.fileno()).st_size
+        if size <= on_disk:
+            self.mm.resize(on_disk) #the file already grew some other way, just map the rest of it
+            return
+        if not self.mm_writable:
+            raise RuntimeError("Cannot grow a read only index file")
+        page = self.fmt.page_size
+        spare = max(map_grow_blocks * page, len(self.mm) // 8)
+        self.mm.resize(-(-(size + spare) // page) * page) #stay on whole blocks
+
+    def _close_map(self, trim=True):
+        if self.mm is None:
+            return
+        self.mm.close()
+        if self.mm_writable and trim:
+            # cut off the spare room the map grew by, the file ends right after the last allocated block
+            end = self._block_offset(self.next_block)
+            if os.fstat(self.map_fp.fileno()).st_size > end:
+                self.map_fp.truncate(end)
+        self.map_fp.close()
+        self.mm = None
+        self.map_fp = None
+
+    def _read_block(self, block_id):
+        # gives back a buffer and where the block starts in it; in mmap mode that is the map itself
+        logged = self.wal_pages.get(block_id)
+        if logged is not None:
+            return logged, 0 #newer than the index file, still only in the log
+        offset = self._block_offset(block_id)
+        end = offset + self.fmt.page_size
+        if self.use_mmap:
+            if self.mm is None:
+                self._open_map()
+            if end > len(self.mm) and end <= os.path.getsize(self.path):
+                self._grow_map(end) #the file grew underneath the map
+            return self.mm, offset
+        return os.pread(self._reader_fd(), self.fmt.page_size, offset), 0 #positional read, safe from any thread
+
+    def _reader_fd(self):
+        with self.mutex:
+            if self.read_fd is None:
+                self.read_fd = os.open(self.path, os.O_RDONLY) #read only mode to read from the disk
+                self.counters['file_opens'] += 1
+            return self.read_fd
+
+    def _write_block(self, block_id, data):
+        self.wrote = True
+        if self.wal:
+            data = bytes(data)
+            self.wal_pending[block_id] = data #goes into the log at the next commit
+            self.wal_pages[block_id] = data
+            return
+        self._put_block(block_id, data)
+
+    def _put_block(self, block_id, data):
+        # writes straight into the index file (or its map)
+        offset = self._block_offset(block_id)
+        if self.use_mmap:
+            if self.mm is None:
+                self._open_map()
+            self._grow_map(offset + self.fmt.page_size)
+            self.mm[offset:offset + self.fmt.page_size] = data #lands in the map, flush() pushes it to the file
+            return
+        if self.session is not None:
+            os.pwrite(self.fp.fileno(), data, offset) #the session's descriptor, nothing to reopen
+            return
+        self.openInrw() #opens it in read/write mode
+        self.fp.seek(offset) #apply the offset
+        self.fp.write(data) #writes the data
+        self.fp.flush() #flush it out
+        self.counters['flushes'] += 1
 
     def _block_offset(self, block_id):
-        return block_id * byte_blocks #converts the block id to an offest by multiplying it by the block size
+        return block_id * self.fmt.page_size #converts the block id to an offest by multiplying it by the block size
 
     def readsHeader(self, must_exist=True):
         if not os.path.exists(self.path):
@@ -122,118 +1109,345 @@ class BTreeFile:
                 raise FileNotFoundError(f"{self.path} does not exist") #cannot find the file current
             else:
                 return #couldn't find it, even if it does exist
+        data = self._header_bytes()
+        if len(data) < 24: #this is the wrong kind of index file if the length is less then 24 bytes
+            raise ValueError("Index file header too small or invalid")# header does not have our correct information
+        magic = data[0:8] #magic number is in the first 8 bytes
+        if magic != magic_number: #if they don't match up, not the right kind of index file
+            raise ValueError("Not a valid index file (wrong magic header)")
+        self._use_format(data) #page size first, the log cannot be read without it
+        if not self.wal_checked and self._recover_wal(): #a crash may have left committed pages in the log
+            data = self._header_bytes() #the replay rewrote the header in the file
+        data = self.wal_pages.get(0) or data #a logged header is newer than the one in the file
+        self.root = bytes_to_int(data[8:16]) #gets the root from these bytes (next bytes after magic number)
+        self.next_block = bytes_to_int(data[16:24]) #gets the next block id from the bytes after the root id
+        self.free_head = bytes_to_int(data[24:32]) if len(data) >= 32 else 0 #start of the free list
+        self.change_count = bytes_to_int(data[32:40]) if len(data) >= 40 else 0
+        if self.pin_internal and self.inner is None:
+            self.load_internal_index()
+        if not self.bloom_checked:
+            self._load_bloom()
 
+    def _header_bytes(self):
+        self.counters['header_reads'] += 1
+        if self.session is not None:
+            return os.pread(self.fp.fileno(), byte_blocks, 0) #same bytes, through the descriptor the session holds
+        self.counters['file_opens'] += 1
         with open(self.path, 'rb') as f: #opens it in a read mode
-            data = f.read(byte_blocks) #rreads the data currently on the file
-            if len(data) < 24: #this is the wrong kind of index file if the length is less then 24 bytes
-                raise ValueError("Index file header too small or invalid")# header does not have our correct information
-            magic = data[0:8] #magic number is in the first 8 bytes
-            if magic != magic_number: #if they don't match up, not the right kind of index file
-                raise ValueError("Not a valid index file (wrong magic header)")
-            self.root = bytes_to_int(data[8:16]) #gets the root from these bytes (next bytes after magic number)
-            self.next_block = bytes_to_int(data[16:24]) #gets the next block id from the bytes after the root id
+            return f.read(byte_blocks) #rreads the data currently on the file, the header always fits in 512 bytes
+
+    def _use_format(self, data):
+        # page size and degree from the header, 0 in a file made before they were stored there
+        page_size = bytes_to_int(data[40:48]) if len(data) >= 48 else 0
+        degree = bytes_to_int(data[48:56]) if len(data) >= 56 else 0
+        flags = bytes_to_int(data[56:64]) if len(data) >= 64 else 0
+        if page_size == 0:
+            page_size, degree = byte_blocks, min_degree
+        if (page_size, degree, flags) == (self.fmt.page_size, self.fmt.min_degree, self.fmt.flags):
+            return
+        fmt = NodeFormat(page_size, degree, flags) if degree > 0 and not flags & ~known_flags else None
+        if fmt is None or page_size % page_unit or page_size > max_page_size or not fmt.fits():
+            raise ValueError("Index file header has a bad page size or degree")
+        self.fmt = fmt
+        if self.cache_mb is not None:
+            self.pool.capacity = max(self.cache_mb * 1024 * 1024 // page_size, min_cache_pages)
 
     def writesHeader(self):
-        self.openInrw() #opens it in the read write mode this time
+        if self.session is not None:
+            self.header_dirty = True #kept in memory, flush() or close() writes it
+            return
+        self._store_header()
+
+    def _flush_header(self):
+        if self.header_dirty:
+            self.header_dirty = False
+            self._store_header()
+
+    def _store_header(self):
+        t0 = time.perf_counter() if self.timed else 0
+        self.counters['header_writes'] += 1
         # build header buffer
         buf = bytearray()
         buf += magic_number # The first 8 bits is the magic number
         buf += int_to_bytes(self.root) # Next 8 is the correct root id
-        buf += int_to_bytes(self.next_block) # Final 8 is the next block
+        buf += int_to_bytes(self.next_block) # Next 8 is the next block
+        buf += int_to_bytes(self.free_head) # Next 8 is the first free block
+        buf += int_to_bytes(self.change_count) # Next 8 is the change counter
+        buf += int_to_bytes(self.fmt.page_size) # Next 8 is the page size
+        buf += int_to_bytes(self.fmt.min_degree) # Next 8 is the degree
+        buf += int_to_bytes(self.fmt.flags) # Final 8 is the format flags
         # error handling
-        if len(buf) > byte_blocks:
+        if len(buf) > self.fmt.page_size:
             raise RuntimeError("Header serialization exceeded block size")
-        buf += bytes(byte_blocks - len(buf)) #adjust buffer to the remaining length
-        self.fp.seek(self._block_offset(0)) # We need to write from block 0, since this is the header
-        self.fp.write(buf) #writes it
-        self.fp.flush() # flush so changes last
+        buf += bytes(self.fmt.page_size - len(buf)) #adjust buffer to the remaining length
+        self._write_block(0, buf) # We need to write from block 0, since this is the header
+        if self.timed:
+            self._record_time('writesHeader', t0)
 
     def validate_header(self):
         self.readsHeader(must_exist=True) #makes sure the header is still correct and has the magic number
 
     def allocate_node(self):
+        if self.free_head != 0:
+            # reuse a freed block before growing the file
+            new_id = self.free_head
+            self.free_head = self.readsNode(new_id).parent #a free block keeps the next free id in its parent slot
+            node = Node(block_id=new_id, fmt=self.fmt)
+            self.writesNode(node)
+            self.writesHeader()
+            return node
         new_id = self.next_block #sets up the next node with the next block available
         self.next_block += 1 #increment for the next block
-        node = Node(block_id=new_id) #makes a new node for what will happen next
+        node = Node(block_id=new_id, fmt=self.fmt) #makes a new node for what will happen next
+        if self.mm is not None:
+            self._grow_map(self._block_offset(self.next_block)) #the map has to cover the new block
         self.writesNode(node) # write node out and put it into the cache
         self.writesHeader()# modify header so we can update next block
         return node
 
+    def free_node(self, node):
+        # puts a block that is no longer in the tree on the front of the free list
+        freed = Node(block_id=node.block_id, fmt=self.fmt)
+        freed.parent = self.free_head
+        freed.n = free_marker
+        self.free_head = node.block_id
+        self.writesNode(freed)
+        self.writesHeader()
+
     # Node cache and creation
 
-    def _cache_put(self, node):
-        bid = node.block_id #puts the node current id as the this one
-        # move existing entry to the end (mark as most-recent)
-        if bid in self.node_cache:
-            del self.node_cache[bid] #puts them out
-        self.node_cache[bid] = node
-        # evict if there are more then 3 nodes
-        while len(self.node_cache) > 3: #if it is greater
-            old_bid, old_node = self.node_cache.popitem(last=False) #pop the item from the cache
-            self._write_node_to_disk(old_node)# write evicted node back to disk to persist any changes
+    def _cache_put(self, node, dirty=False):
+        if self.timed:
+            t0 = time.perf_counter()
+            self.pool.put(node, dirty)
+            self._record_time('_cache_put', t0)
+            return
+        self.pool.put(node, dirty) #most recent in the pool, may write back an evicted dirty node
 
     def _write_node_to_disk(self, node):
-        self.openInrw() #opens it in read/write mode
-        data = node.to_bytes() #gets the data from node
-        self.fp.seek(self._block_offset(node.block_id)) #apply the offset
-        self.fp.write(data) #writes the data
-        self.fp.flush() #flush it out
+        t0 = time.perf_counter() if self.timed else 0
+        self.counters['block_writes'] += 1
+        self._write_block(node.block_id, node.to_bytes()) #into the map or the file, depending on the mode
+        if self.timed:
+            self._record_time('_write_node_to_disk', t0)
 
     def writesNode(self, node):
-        self._cache_put(node)# put node in the cache, if it gets evicted, it will get out of the cache
-        self._write_node_to_disk(node)# writes it to disk afterwards, helps function
+        self._cache_put(node, dirty=True)# only marks it dirty, it reaches the disk when evicted or flushed
+        if self.inner is not None:
+            self._index_node(node) #splits, merges and frees all come through here, so the index stays current
 
-    def readsNode(self, block_id):
-        # cache fast-path
-        if block_id in self.node_cache:
-            node = self.node_cache.pop(block_id) #move it to the end of the queue aka cache
-            self.node_cache[block_id] = node# re-insert as most-recent and return
-            return node
+    # in-memory index of the internal levels
+    def load_internal_index(self):
+        # reads every node above the leaf level once; the tree is balanced, so the leftmost path gives the height
+        self.inner = {}
+        if self.root == 0:
+            return
+        height = 1
+        bid = self.root
+        while True:
+            node = self.readsNode(bid)
+            if node.is_leaf():
+                break
+            height += 1
+            bid = node.children[0]
+        level = [self.root]
+        for _ in range(height - 1): #every level except the leaves
+            below = []
+            for bid in level:
+                node = self.readsNode(bid)
+                self._index_node(node)
+                below.extend(node.children[:node.n + 1])
+            level = below
 
-        with open(self.path, 'rb') as f: #read only mode to read from the disk
-            f.seek(self._block_offset(block_id))
-            data = f.read(byte_blocks) #read happens
-            if len(data) != byte_blocks:
-                # Handles if the file being read from has something happen to it
-                raise RuntimeError(f"Failed to read full block for block id {block_id}")
-            node = Node.from_bytes(data)# gets the data from bytes
+    def _index_node(self, node):
+        if node.n == free_marker or node.is_leaf():
+            self.inner.pop(node.block_id, None) #leaves and free blocks are read from the file
+            return
+        n = node.n
+        self.inner[node.block_id] = (node.keys[:n], node.values[:n], node.children[:n + 1]) #trimmed copies, no padding
 
-        # add node to cache (may evict other nodes)
-        self._cache_put(node) #put the node in the cache
+    def readsNode(self, block_id):
+        t0 = time.perf_counter() if self.timed else 0
+        with self.mutex:
+            # cache fast-path
+            node = self.pool.get(block_id) #also marks it as the most recent
+            if node is not None:
+                self.counters['cache_hits'] += 1
+                if self.timed:
+                    self._record_time('readsNode_hit', t0) #kept apart so readsNode stays the cost of a miss
+                return node
+            loaded = self.loading.get(block_id)
+            if loaded is None:
+                self.loading[block_id] = threading.Event() #this thread reads it, others asking meanwhile wait
+                self.counters['cache_misses'] += 1
+                self.counters['block_reads'] += 1
+            else:
+                self.counters['coalesced_reads'] += 1
+        if loaded is not None:
+            loaded.wait() #another thread is already reading this block, take its copy from the pool
+            return self.readsNode(block_id)
+        try:
+            if self.use_mmap:
+                with self.mutex: #the map cannot be grown while a node is being decoded out of it
+                    node = self._decode_block(block_id)
+            else:
+                node = self._decode_block(block_id) #outside the lock so threads wait on the disk together
+            with self.mutex:
+                # add node to cache (may evict other nodes)
+                self._cache_put(node) #put the node in the cache
+                if self.timed:
+                    self._record_time('readsNode', t0)
+        finally:
+            with self.mutex:
+                self.loading.pop(block_id).set()
         return node # returns it
 
+    def _decode_block(self, block_id):
+        data, start = self._read_block(block_id)
+        if len(data) - start < self.fmt.page_size:
+            # Handles if the file being read from has something happen to it
+            raise RuntimeError(f"Failed to read full block for block id {block_id}")
+        return Node.from_bytes(memoryview(data), start, self.fmt)# decodes straight from the block
+
+    # instrumentation
+    def _record_time(self, name, start):
+        elapsed = time.perf_counter() - start
+        if self.timings is not None:
+            entry = self.timings.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+        if self.timing_hook is not None:
+            self.timing_hook(name, elapsed)
+
+    def stats(self):
+        # counters since this BTreeFile was made, plus the buffer pool and (when kept) the call timings
+        out = dict(self.counters)
+        out['cache_evictions'] = self.pool.evictions
+        out['cache_write_backs'] = self.pool.write_backs
+        out['cache_pages'] = len(self.pool)
+        out['cache_dirty'] = len(self.pool.dirty)
+        if self.timings is not None:
+            out['timings'] = {name: {'calls': calls, 'seconds': round(total, 6)}
+                              for name, (calls, total) in self.timings.items()}
+        return out
+
+    def tree_stats(self):
+        # shape of the tree on disk: height, nodes, how full they are and how much of the file is free
+        self.openAndLoadHeader()
+        with self.reading():
+            return self._tree_stats()
+
+    def _tree_stats(self):
+        height = nodes = leaves = keys = fill = 0
+        level = [self.root] if self.root != 0 else []
+        while level:
+            height += 1
+            below = []
+            for bid in level:
+                node = self.readsNode(bid)
+                nodes += 1
+                if node.is_leaf() or not self.fmt.bplus: #B+ separators are copies of leaf keys
+                    keys += node.n
+                fill += node.packed_size() if self.fmt.packed else node.n #bytes used in a packed file
+                if node.is_leaf():
+                    leaves += 1
+                else:
+                    below.extend(node.children[:node.n + 1])
+            level = below
+        free = 0
+        bid = self.free_head
+        while bid != 0: #free blocks chain through their parent slot
+            free += 1
+            bid = self.readsNode(bid).parent
+        blocks = self.next_block - 1 #every block after the header
+        return {
+            'height': height,
+            'nodes': nodes,
+            'leaves': leaves,
+            'keys': keys,
+            'page_size': self.fmt.page_size,
+            'degree': self.fmt.min_degree,
+            'packed': self.fmt.packed,
+            'bplus': self.fmt.bplus,
+            'fill_factor': round(fill / (nodes * (self.fmt.page_size if self.fmt.packed else self.fmt.max_keys)), 4) if nodes else 0.0,
+            'file_blocks': blocks,
+            'used_blocks': nodes,
+            'free_blocks': free,
+            'free_ratio': round(free / blocks, 4) if blocks else 0.0,
+            'bloom': 'stale' if self.bloom_stale else 'none' if self.bloom is None else 'ok',
+            'bloom_fp_estimate': round(self.bloom.estimated_fp(), 6) if self.bloom is not None else 0.0,
+        }
+
     # B-tree operations
-    def create(self):
+    def create(self, page_size=byte_blocks, packed=False, bplus=False):
         if os.path.exists(self.path): #the file already exists, error below
             print("Error: file already exists", file=sys.stderr) #tell user it exists
             sys.exit(1)
+        if page_size % page_unit or not page_unit <= page_size <= max_page_size:
+            print(f"Error: page size must be a multiple of {page_unit} up to {max_page_size}", file=sys.stderr)
+            sys.exit(1)
+        # the classic 512 byte page keeps degree 10, bigger pages get the largest degree that fits
+        flags = (packed_flag if packed else 0) | (bplus_flag if bplus else 0)
+        if flags:
+            self.fmt = NodeFormat(page_size, flags=flags)
+        else:
+            self.fmt = default_format if page_size == byte_blocks else NodeFormat(page_size)
+        if os.path.exists(self._bloom_path()):
+            os.remove(self._bloom_path()) #left behind by an older index at this path, it would describe other keys
+        self._write_empty_index(self.path, self.fmt)
+        print(f"Created index file {self.path}") #tell user it was created
 
-        with open(self.path, 'wb') as f: #open in write mode
+    @staticmethod
+    def _write_empty_index(path, fmt=default_format):
+        with open(path, 'wb') as f: #open in write mode
             buf = bytearray()
             buf += magic_number #put in our magic number as the header
             buf += int_to_bytes(0)  # root id is 0 since there is a new file
             buf += int_to_bytes(1)  # next block id will be 1
-            buf += bytes(byte_blocks - len(buf))  # pad to full block
+            buf += int_to_bytes(0)  # nothing on the free list
+            buf += int_to_bytes(0)  # change counter
+            buf += int_to_bytes(fmt.page_size)
+            buf += int_to_bytes(fmt.min_degree)
+            buf += int_to_bytes(fmt.flags)
+            buf += bytes(fmt.page_size - len(buf))  # pad to full block
             f.write(buf) #write this out
-        print(f"Created index file {self.path}") #tell user it was created
 
     def openAndLoadHeader(self):
+        if self.session is not None:
+            return #checked when the session opened, and kept in memory since
         if not os.path.exists(self.path):#the file already exists, error below
             print("Error: file does not exist", file=sys.stderr) #tell user it exists
             sys.exit(1)
         self.readsHeader(must_exist=True) #checks the read header and it needs to be correct
 
     def searchKey(self, key):
+        with self.reading():
+            return self._search_key(key)
+
+    def _search_key(self, key):
         if self.root == 0: # returns nothing because it is empty!
             return None, None
+        if self.bloom is not None and key not in self.bloom:
+            self.counters['bloom_negatives'] += 1
+            return None, None #certainly not there, no block is read
+        if self.inner is not None:
+            # walk the internal levels in memory, only the leaf (or the internal node holding the key) gets read
+            bid = self.root
+            while bid in self.inner:
+                keys, values, children = self.inner[bid]
+                i = bisect_left(keys, key)
+                if i < len(keys) and keys[i] == key and not self.fmt.bplus: #a B+ separator has no pair behind it
+                    return self.readsNode(bid), i
+                bid = children[i]
+            return self._search_in_node(bid, key)
         return self._search_in_node(self.root, key) #calls helper function and returns it
 
     def _search_in_node(self, block_id, key):
+        if self.fmt.bplus:
+            return self._search_leaf(block_id, key)
         node = self.readsNode(block_id) #reads the node based on the block_id given
-        # linear scan in node (since keys are stored in-order)
-        i = 0
-        while i < node.n and key > node.keys[i]: #increment i
-            i += 1
+        # binary search in node (since keys are stored in-order), big pages hold hundreds of keys
+        i = bisect_left(node.keys, key, 0, node.n)
         if i < node.n and key == node.keys[i]: #if the key matches the one passed, return the incrementation number and the node
             return node, i
         # not in this node; if leaf -> not found
@@ -246,8 +1460,113 @@ class BTreeFile:
             return None, None
         return self._search_in_node(child_bid, key) #try again in other node
 
+    def _search_leaf(self, block_id, key):
+        # B+ tree: the internal keys only steer, every pair is in a leaf
+        node = self.readsNode(block_id)
+        while not node.is_leaf():
+            node = self.readsNode(node.children[bisect_left(node.keys, key, 0, node.n)]) #equal keys may sit on the left
+        i = bisect_left(node.keys, key, 0, node.n)
+        if i == node.n and node.children[self.fmt.next_slot] != 0:
+            # past the end of this leaf, the key can only be the first one of the next leaf
+            node = self.readsNode(node.children[self.fmt.next_slot])
+            i = 0
+        if i < node.n and node.keys[i] == key:
+            return node, i
+        return None, None
+
+    def search_many(self, keys, batch_size=search_batch, threads=1):
+        # yields (key, value) for every key in the order given, value is None when the key is not there
+        # keys are taken in batches, sorted, and looked up together so each node is read once per batch
+        # with threads > 1 each batch is cut into that many key ranges, looked up side by side
+        workers = concurrent.futures.ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        try:
+            batch = []
+            for k in keys:
+                batch.append(k)
+                if len(batch) >= batch_size:
+                    yield from self._search_batch(batch, workers, threads)
+                    batch = []
+            if batch:
+                yield from self._search_batch(batch, workers, threads)
+        finally:
+            if workers is not None:
+                workers.shutdown()
+
+    def _search_batch(self, keys, workers=None, threads=1):
+        found = [None] * len(keys) #value for each key, by its position in the input
+        with self.reading(): #held for the worker threads too, they only go through the pool's mutex
+            if self.root != 0:
+                order = range(len(keys))
+                if self.bloom is not None:
+                    order = [pos for pos in order if keys[pos] in self.bloom] #the rest are certainly missing
+                    self.counters['bloom_negatives'] += len(keys) - len(order)
+                order = sorted(order, key=keys.__getitem__) #positions in key order
+                if workers is None or len(order) < threads * 2:
+                    self._search_group(self.root, keys, order, found)
+                else:
+                    step = -(-len(order) // threads)
+                    parts = [order[i:i + step] for i in range(0, len(order), step)] #each thread fills its own slots
+                    for f in [workers.submit(self._search_group, self.root, keys, part, found) for part in parts]:
+                        f.result()
+        return zip(keys, found)
+
+    def _search_group(self, block_id, keys, positions, found):
+        # positions are sorted by key, so the keys going to the same child sit next to each other
+        if self.inner is not None and block_id in self.inner:
+            node_keys, node_values, children = self.inner[block_id]
+            n = len(node_keys)
+        else:
+            node = self.readsNode(block_id)
+            node_keys, node_values, children, n = node.keys, node.values, node.children, node.n
+            if self.fmt.bplus and node.is_leaf():
+                self._search_leaf_group(node, keys, positions, found)
+                return
+        bplus = self.fmt.bplus
+        group = [] #positions heading into the child at index child_i
+        child_i = -1
+        for pos in positions:
+            k = keys[pos]
+            i = bisect_left(node_keys, k, 0, n)
+            if i < n and node_keys[i] == k and not bplus:
+                found[pos] = node_values[i]
+                continue
+            if i != child_i:
+                if group and children[child_i] != 0:
+                    self._search_group(children[child_i], keys, group, found)
+                group = []
+                child_i = i
+            group.append(pos)
+        if group and children[child_i] != 0: #child 0 means a leaf, so those keys are not found
+            self._search_group(children[child_i], keys, group, found)
+
+    def _search_leaf_group(self, node, keys, positions, found):
+        # B+ leaf: keys past its end can only be the first key of the next leaf, which is read once for all of them
+        n = node.n
+        past = []
+        for pos in positions:
+            k = keys[pos]
+            i = bisect_left(node.keys, k, 0, n)
+            if i == n:
+                past.append(pos)
+            elif node.keys[i] == k:
+                found[pos] = node.values[i]
+        if past and node.children[self.fmt.next_slot] != 0:
+            after = self.readsNode(node.children[self.fmt.next_slot])
+            for pos in past:
+                if after.n and after.keys[0] == keys[pos]:
+                    found[pos] = after.values[0]
+
     def insert(self, key, value):
+        with self.writing():
+            self._insert(key, value)
+            self._end_op() #one finished operation for the log's group commit
+
+    def _insert(self, key, value):
+        if not (int64_min <= key <= int64_max and int64_min <= value <= int64_max):
+            raise OverflowError("keys and values must fit in 64 bits") #before any node is changed
         self.openAndLoadHeader() #validates header is good first
+        if self.bloom is not None:
+            self.bloom.add(key) #before the tree changes, so the filter on disk is marked behind first
         if self.root == 0: #this is the root node
             # create root node
             new_root = self.allocate_node() #make space for the root
@@ -260,9 +1579,12 @@ class BTreeFile:
             self.writesNode(new_root) #writes it
             self.writesHeader() #makes the header
             return #exit since we made the root node
+        if self.fmt.packed:
+            self._insert_packed(key, value) #packed nodes fill by bytes, they split after the fact
+            return
 
         root_node = self.readsNode(self.root)
-        if root_node.n == max_keys: #roots full, make a new one
+        if root_node.n == self.fmt.max_keys: #roots full, make a new one
             # we need to split up
             s = self.allocate_node() #allocate the new node
             s.parent = 0 #initialization
@@ -310,7 +1632,7 @@ class BTreeFile:
                 self.writesNode(node)
                 return
             child = self.readsNode(child_bid) #read the child node
-            if child.n == max_keys: #we're full, need to split it
+            if child.n == self.fmt.max_keys: #we're full, need to split it
                 # split child so we have room to insert
                 self._split_child(node, i) #splits it into two nodes now
                 # after split, decide which of the two children to descend into
@@ -319,98 +1641,850 @@ class BTreeFile:
                 child = self.readsNode(node.children[i])
             self._insert_nonfull(child, key, value) #recursively put more into the child node
 
+    def _insert_packed(self, key, value):
+        # bottom up: the pair goes straight into its leaf, then any node that no longer fits its page is split
+        node = self.readsNode(self.root)
+        while not node.is_leaf():
+            node = self.readsNode(node.children[bisect_right(node.keys, key, 0, node.n)]) #equal keys go right
+        n = node.n
+        pos = bisect_right(node.keys, key, 0, n)
+        node.reserve(n + 1)
+        node.keys[pos + 1:n + 1] = node.keys[pos:n]
+        node.values[pos + 1:n + 1] = node.values[pos:n]
+        node.keys[pos] = key
+        node.values[pos] = value
+        node.n = n + 1
+        self.pool.pin(node.block_id) #an oversized node must not be written back before it is split
+        try:
+            self.writesNode(node)
+            self._fix_overflow(node)
+        finally:
+            self.pool.unpin(node.block_id)
+
+    def _overflows(self, node):
+        return node.n > self.fmt.max_keys or node.packed_size() > self.fmt.page_size
+
+    def _fix_overflow(self, node):
+        # splits a packed node that outgrew its page in the middle, the median goes up to its parent,
+        # which may outgrow its own page and get split in turn, up to a new root
+        # both halves keep at least t - 1 pairs: a node only overflows with 2t or more
+        # a half can still be too big when the new pair made every entry wider, so the halves are checked again,
+        # after the parent, so no node is ever more than one pair over
+        self.pool.pin(node.block_id)
+        work = [node] #every node on here holds one pin
+        try:
+            while work:
+                node = work.pop()
+                if not self._overflows(node):
+                    self.pool.unpin(node.block_id)
+                    continue
+                if node.parent == 0:
+                    parent = self.allocate_node()
+                    parent.children[0] = node.block_id
+                    node.parent = parent.block_id
+                    self.root = parent.block_id
+                    self.writesNode(node)
+                    self.writesNode(parent)
+                    self.writesHeader()
+                else:
+                    parent = self.readsNode(node.parent)
+                self.pool.pin(parent.block_id)
+                z = self._split_child(parent, parent.children.index(node.block_id, 0, parent.n + 1))
+                self.pool.pin(z.block_id)
+                work += [node, z, parent]
+        finally:
+            for left in work:
+                self.pool.unpin(left.block_id)
+
     def _split_child(self, parent_node, i):
-        y = self.readsNode(parent_node.children[i]) #read the node of the children
-        z = self.allocate_node()
-        z.parent = parent_node.block_id
+        # pin the three nodes being changed so reading the moved children cannot evict them halfway through
+        pinned = [parent_node.block_id]
+        self.pool.pin(parent_node.block_id)
+        try:
+            y = self.readsNode(parent_node.children[i]) #read the node of the children
+            self.pool.pin(y.block_id)
+            pinned.append(y.block_id)
+            z = self.allocate_node()
+            self.pool.pin(z.block_id)
+            pinned.append(z.block_id)
+            self._split_into(parent_node, i, y, z)
+        finally:
+            for bid in pinned:
+                self.pool.unpin(bid)
+        return z
 
-        # copies the last min_degree-1 keys and values to z
-        for j in range(min_degree, max_keys):  # j runs min_degree tp max_keys-1
-            z.keys[j - min_degree] = y.keys[j]
-            z.values[j - min_degree] = y.values[j]
+    def _split_into(self, parent_node, i, y, z):
+        z.parent = parent_node.block_id
+        n = y.n
+        mid = n // 2 #the median goes up; a full node has 2t - 1 keys, so t - 1 stay on each side
+        leaf = y.is_leaf()
+        copy_up = leaf and self.fmt.bplus #a B+ leaf keeps the median pair in z, only a copy of its key goes up
+        start = mid if copy_up else mid + 1
+        moved = n - start
+        z.reserve(moved)
+        parent_node.reserve(parent_node.n + 1)
 
-        # copies last min_degree children to z also, since it's a different number need to do this
-        for j in range(min_degree, children_num):
-            z.children[j - min_degree] = y.children[j]
+        # copies the keys and values after the median to z
+        z.keys[0:moved] = y.keys[start:n]
+        z.values[0:moved] = y.values[start:n]
 
         # set counts
-        z.n = min_degree - 1
-        y.n = min_degree - 1
-
-        # update parent pointers of moved children (if any)
-        for j in range(min_degree):
-            cid = z.children[j]
-            if cid != 0:
-                childnode = self.readsNode(cid) #read the childnode based off the child id
+        z.n = moved
+        y.n = mid
+
+        if copy_up:
+            # z goes between y and the leaf after it
+            z.children[self.fmt.next_slot] = y.children[self.fmt.next_slot]
+            y.children[self.fmt.next_slot] = z.block_id
+        elif not leaf:
+            # copies the children after the median to z also, since it's a different number need to do this
+            z.children[0:moved + 1] = y.children[mid + 1:n + 1]
+            y.children[mid + 1:n + 1] = array('q', bytes(8 * (moved + 1)))
+            # update parent pointers of moved children
+            for j in range(moved + 1):
+                childnode = self.readsNode(z.children[j]) #read the childnode based off the child id
                 childnode.parent = z.block_id #put z block as the paren
                 self.writesNode(childnode) #write it
 
         # insert z as parent's child i+1, make room by shifting
-        for j in range(parent_node.n, i, -1):
-            parent_node.children[j + 1] = parent_node.children[j] #moves and shifts the child
+        pn = parent_node.n
+        parent_node.children[i + 2:pn + 2] = parent_node.children[i + 1:pn + 1] #moves and shifts the children
         parent_node.children[i + 1] = z.block_id # put the final one as z's id
 
         # shift parent's keys/values to make space
-        for j in range(parent_node.n - 1, i - 1, -1):
-            parent_node.keys[j + 1] = parent_node.keys[j]
-            parent_node.values[j + 1] = parent_node.values[j]
+        parent_node.keys[i + 1:pn + 1] = parent_node.keys[i:pn]
+        parent_node.values[i + 1:pn + 1] = parent_node.values[i:pn]
 
         # move median key from y up to parent
-        parent_node.keys[i] = y.keys[min_degree - 1]
-        parent_node.values[i] = y.values[min_degree - 1]
+        parent_node.keys[i] = y.keys[mid]
+        parent_node.values[i] = 0 if self.fmt.bplus else y.values[mid] #B+ separators carry no value
         parent_node.n += 1
 
         # clears the moved slots, makes sure it's correct
-        for j in range(min_degree - 1, max_keys):
-            y.keys[j] = 0
-            y.values[j] = 0
-        for j in range(min_degree, children_num):
-            y.children[j] = 0
+        cleared = array('q', bytes(8 * (n - mid)))
+        y.keys[mid:n] = cleared
+        y.values[mid:n] = cleared
 
         # writes them to the disk
         self.writesNode(y)
         self.writesNode(z)
         self.writesNode(parent_node)
 
+    # Deleting
+    def delete(self, key):
+        # removes one pair with this key, rebalancing on the way down so no node ends up below t - 1 keys
+        # gives back the value that was removed, or None if the key is not in the tree
+        with self.writing():
+            return self._delete(key)
+
+    def _delete(self, key):
+        self.openAndLoadHeader() #validates header is good first
+        if self.root == 0:
+            return None
+        try:
+            root_node = self._hold(self.readsNode(self.root))
+            if self.fmt.bplus:
+                pair = self._delete_bplus(key)
+            else:
+                pair = self._delete_from(root_node, key, 'key')
+            if root_node.n == 0: #the root lost its last key, either the tree is empty or its only child takes over
+                if root_node.is_leaf():
+                    self.root = 0
+                else:
+                    new_root = self.readsNode(root_node.children[0])
+                    new_root.parent = 0
+                    self.writesNode(new_root)
+                    self.root = new_root.block_id
+                self.free_node(root_node) #also writes the header with the new root
+            if self.fmt.packed:
+                # a borrowed or swapped in separator can be wider than the one it replaced, so a packed node
+                # on the path may have grown past its page; they are all still pinned here
+                for bid in dict.fromkeys(self.held):
+                    node = self.readsNode(bid)
+                    if node.n != free_marker:
+                        self._fix_overflow(node)
+        finally:
+            for bid in self.held:
+                self.pool.unpin(bid)
+            self.held = []
+        self._end_op()
+        return None if pair is None else pair[1]
+
+    def _hold(self, node):
+        self.pool.pin(node.block_id)
+        self.held.append(node.block_id)
+        return node
+
+    def _delete_from(self, x, key, mode):
+        # x has at least t keys here unless it is the root, so taking one out never underfills it
+        # mode 'key' removes a pair with this key; 'max' and 'min' remove the largest or smallest pair
+        # in the subtree, which is how an internal key gets replaced by its predecessor or successor
+        leaf = x.is_leaf()
+        if mode == 'key':
+            i = bisect_left(x.keys, key, 0, x.n)
+            hit = i < x.n and x.keys[i] == key
+        elif mode == 'max':
+            i = x.n - 1 if leaf else x.n
+            hit = leaf
+        else:
+            i = 0
+            hit = leaf
+        if leaf:
+            if not hit:
+                return None #not in the tree
+            pair = (x.keys[i], x.values[i])
+            self._remove_at(x, i)
+            self.writesNode(x)
+            return pair
+        if hit:
+            # the key is in this internal node, swap in a neighbour from a child that can spare one
+            pair = (x.keys[i], x.values[i])
+            y = self._hold(self.readsNode(x.children[i]))
+            if y.n >= self.fmt.min_degree:
+                x.keys[i], x.values[i] = self._delete_from(y, key, 'max')
+                self.writesNode(x)
+                return pair
+            z = self._hold(self.readsNode(x.children[i + 1]))
+            if z.n >= self.fmt.min_degree:
+                x.keys[i], x.values[i] = self._delete_from(z, key, 'min')
+                self.writesNode(x)
+                return pair
+            self._merge_children(x, i, y, z) #both are minimal, the key moves down into the merged node
+            return self._delete_from(y, key, 'key')
+        return self._delete_from(self._fix_child(x, i), key, mode)
+
+    def _delete_bplus(self, key):
+        # B+ tree: the pair comes out of its leaf, then a node left under t - 1 keys borrows from or merges with
+        # a sibling, going up the parent links. Separators of deleted keys can stay, they still steer correctly
+        node, i = self._search_leaf(self.root, key)
+        if node is None:
+            return None
+        self._hold(node)
+        pair = (node.keys[i], node.values[i])
+        self._remove_at(node, i)
+        self.writesNode(node)
+        while node.parent != 0 and node.n < self.fmt.min_degree - 1:
+            x = self._hold(self.readsNode(node.parent))
+            i = x.children.index(node.block_id, 0, x.n + 1)
+            if node.is_leaf():
+                self._fix_leaf(x, i)
+            else:
+                self._fix_child(x, i) #internal B+ nodes rebalance like B-tree nodes, through the separator
+            node = x
+        return pair
+
+    def _fix_leaf(self, x, i):
+        # B+ leaf i of x is under t - 1 pairs: take one from a neighbour that can spare it, or merge with one
+        # a separator that changes becomes the first key of the leaf on its right
+        t = self.fmt.min_degree
+        c = self.readsNode(x.children[i])
+        left = right = None
+        if i > 0:
+            left = self._hold(self.readsNode(x.children[i - 1]))
+            if left.n >= t:
+                c.reserve(c.n + 1)
+                c.keys[1:c.n + 1] = c.keys[0:c.n]
+                c.values[1:c.n + 1] = c.values[0:c.n]
+                c.keys[0], c.values[0] = left.keys[left.n - 1], left.values[left.n - 1]
+                c.n += 1
+                self._remove_at(left, left.n - 1)
+                x.keys[i - 1] = c.keys[0]
+                self.writesNode(left)
+                self.writesNode(c)
+                self.writesNode(x)
+                return
+        if i < x.n:
+            right = self._hold(self.readsNode(x.children[i + 1]))
+            if right.n >= t:
+                c.reserve(c.n + 1)
+                c.keys[c.n], c.values[c.n] = right.keys[0], right.values[0]
+                c.n += 1
+                self._remove_at(right, 0)
+                x.keys[i] = right.keys[0]
+                self.writesNode(right)
+                self.writesNode(c)
+                self.writesNode(x)
+                return
+        if left is not None: #merge into the left neighbour, otherwise the right one merges into c
+            left, right, i = left, c, i - 1
+        else:
+            left = c
+        n = left.n
+        left.reserve(n + right.n)
+        left.keys[n:n + right.n] = right.keys[:right.n]
+        left.values[n:n + right.n] = right.values[:right.n]
+        left.n = n + right.n
+        left.children[self.fmt.next_slot] = right.children[self.fmt.next_slot] #right drops out of the leaf chain
+        self._remove_at(x, i, child_at=i + 1)
+        self.writesNode(left)
+        self.writesNode(x)
+        self.free_node(right)
+
+    def _fix_child(self, x, i):
+        # makes sure child i of x has at least t keys before going into it
+        # gives back the node to go into, which is the left sibling if the two got merged
+        t = self.fmt.min_degree
+        c = self._hold(self.readsNode(x.children[i]))
+        if c.n >= t:
+            return c
+        left = right = None
+        if i > 0:
+            left = self._hold(self.readsNode(x.children[i - 1]))
+            if left.n >= t:
+                # borrow through the parent: x's separator comes down to the front of c, left's last key goes up
+                c.reserve(c.n + 1)
+                for j in range(c.n, 0, -1):
+                    c.keys[j] = c.keys[j - 1]
+                    c.values[j] = c.values[j - 1]
+                if not c.is_leaf():
+                    for j in range(c.n + 1, 0, -1):
+                        c.children[j] = c.children[j - 1]
+                    c.children[0] = left.children[left.n]
+                    left.children[left.n] = 0
+                    self._set_parent(c.children[0], c.block_id)
+                c.keys[0], c.values[0] = x.keys[i - 1], x.values[i - 1]
+                c.n += 1
+                x.keys[i - 1], x.values[i - 1] = left.keys[left.n - 1], left.values[left.n - 1]
+                left.keys[left.n - 1] = 0
+                left.values[left.n - 1] = 0
+                left.n -= 1
+                self.writesNode(left)
+                self.writesNode(c)
+                self.writesNode(x)
+                return c
+        if i < x.n:
+            right = self._hold(self.readsNode(x.children[i + 1]))
+            if right.n >= t:
+                # the mirror image: x's separator goes to the end of c, right's first key goes up
+                c.reserve(c.n + 1)
+                c.keys[c.n], c.values[c.n] = x.keys[i], x.values[i]
+                if not c.is_leaf():
+                    c.children[c.n + 1] = right.children[0]
+                    self._set_parent(right.children[0], c.block_id)
+                c.n += 1
+                x.keys[i], x.values[i] = right.keys[0], right.values[0]
+                self._remove_at(right, 0, child_at=0 if not right.is_leaf() else None)
+                self.writesNode(right)
+                self.writesNode(c)
+                self.writesNode(x)
+                return c
+        if left is not None:
+            self._merge_children(x, i - 1, left, c)
+            return left
+        self._merge_children(x, i, c, right)
+        return c
+
+    def _merge_children(self, x, i, y, z):
+        # y (child i), x's key i and z (child i + 1) become one node in y's block, z's block is freed
+        t = y.n
+        y.reserve(t + 1 + z.n)
+        y.keys[t], y.values[t] = x.keys[i], x.values[i]
+        for j in range(z.n):
+            y.keys[t + 1 + j] = z.keys[j]
+            y.values[t + 1 + j] = z.values[j]
+        if not z.is_leaf():
+            for j in range(z.n + 1):
+                y.children[t + 1 + j] = z.children[j]
+                self._set_parent(z.children[j], y.block_id)
+        y.n = t + 1 + z.n
+        self._remove_at(x, i, child_at=i + 1)
+        self.writesNode(y)
+        self.writesNode(x)
+        self.free_node(z)
+
+    def _remove_at(self, node, i, child_at=None):
+        # takes out key/value i, and the child pointer at child_at when given, closing the gap
+        n = node.n
+        for j in range(i, n - 1):
+            node.keys[j] = node.keys[j + 1]
+            node.values[j] = node.values[j + 1]
+        node.keys[n - 1] = 0
+        node.values[n - 1] = 0
+        if child_at is not None:
+            for j in range(child_at, n):
+                node.children[j] = node.children[j + 1]
+            node.children[n] = 0
+        node.n = n - 1
+
+    def _set_parent(self, block_id, parent_id):
+        child = self.readsNode(block_id)
+        child.parent = parent_id
+        self.writesNode(child)
+
+    def vacuum(self):
+        # rewrites the whole index in key order into a new file with no free blocks, then swaps it in
+        # the files are swapped and the tree goes on with the new one, a session keeps going on it too
+        self.openAndLoadHeader()
+        with self.writing(): #other processes wait on the old file and move to the new one once it is in place
+            self._vacuum()
+
+    def _vacuum(self):
+        count = sum(1 for _ in self.scan()) #bulk load has to know the size up front
+        tmp_path = self.path + '.vacuum'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path) #left over from an earlier vacuum that did not finish
+        self._write_empty_index(tmp_path, self.fmt) #same page size and degree
+        compact = BTreeFile(tmp_path)
+        compact.readsHeader()
+        if self.bloom is not None: #the new file gets a filter of its own, built while it is loaded
+            compact.bloom = BloomFilter.sized(compact._bloom_path(), count, self.bloom.fp_rate)
+        compact.bulkLoad(self.scan(), count)
+        compact._save_bloom()
+        with open(tmp_path, 'r+b') as f:
+            os.fsync(f.fileno()) #all of the new file is on disk before it replaces the old one
+        session = self.session
+        self.close()
+        self.wrote = False #what was written went to the old file, nothing to mark in the new one
+        os.replace(tmp_path, self.path)
+        if compact.bloom is not None:
+            os.replace(compact._bloom_path(), self._bloom_path())
+        self.bloom = None #belongs to the old file, the next header read finds the new one
+        self.bloom_checked = False
+        # everything held from the old file: its block ids mean other nodes in the new one
+        self.pool.clear()
+        self.inner = None
+        self.wal_pages.clear()
+        self.wal_checked = False
+        if session is not None:
+            self._open_session(session) #the session goes on with the new file
+        else:
+            self.readsHeader()
+
     # Miscellanous things for operations other
-    def _inorder_traverse(self, block_id, action):
-        if block_id == 0: #root just back out
+    def scan(self, lo=None, hi=None):
+        # yields (key, value) in key order for lo <= key <= hi (None means no bound), one pair at a time
+        with self.reading(): #held until the scan is finished or dropped
+            yield from self._scan(lo, hi)
+
+    def scan_chunk(self, lo, hi, skip, count):
+        # up to count pairs of scan(lo, hi) after the first skip, and the lo and skip the next chunk starts from;
+        # every chunk is its own scan, so no lock is held between chunks
+        pairs = self.scan(lo, hi)
+        try:
+            chunk = list(islice(pairs, skip, skip + count))
+        finally:
+            pairs.close() #lets go of the read lock on this thread
+        if chunk:
+            last = chunk[-1][0]
+            if last == lo:
+                skip += len(chunk) #the whole chunk had key lo
+            else:
+                skip = sum(1 for k, _ in chunk if k == last) #the next scan starts at the last key, these are done
+            lo = last
+        return chunk, lo, skip
+
+    def _scan(self, lo, hi):
+        # the stack holds (node, next key index) for the path from the root, so parents are never re-read
+        if self.root == 0:
             return
-        node = self.readsNode(block_id) #reads the node
-        for i in range(node.n): #loop through for number of keys here
-            child_bid = node.children[i] #see if there is any child
-            if child_bid != 0: #if there is an id here
-                self._inorder_traverse(child_bid, action) #recurse again
-            action(node.keys[i], node.values[i])
-        last_child = node.children[node.n]
-        if last_child != 0:
-            self._inorder_traverse(last_child, action) #recurse again
-
-    def printAll(self):
-        self.openAndLoadHeader() #makes sure its valid
-        if self.root == 0: # if there is nothing, empty
+        if self.fmt.bplus:
+            yield from self._scan_leaves(lo, hi)
             return
-        def printer(k, v): #function called printer
+        stack = []
+        bid = self.root
+        while bid != 0: #seek: go down to the first key >= lo
+            node = self.readsNode(bid)
+            i = 0 if lo is None else bisect_left(node.keys, lo, 0, node.n)
+            stack.append((node, i))
+            bid = node.children[i] #0 once we are in a leaf
+        while stack:
+            node, i = stack.pop()
+            if node.is_leaf(): #the rest of a leaf goes out in one run
+                n = node.n
+                end = n if hi is None else bisect_right(node.keys, hi, i, n)
+                yield from zip(node.keys[i:end], node.values[i:end])
+                if end < n:
+                    return
+                continue
+            if i >= node.n:
+                continue #this node is used up, its parent key is next
+            k = node.keys[i]
+            if hi is not None and k > hi:
+                return
+            yield k, node.values[i]
+            stack.append((node, i + 1))
+            bid = node.children[i + 1]
+            while bid != 0: #the next key is the leftmost one in the subtree to its right
+                child = self.readsNode(bid)
+                stack.append((child, 0))
+                bid = child.children[0]
+
+    def _scan_leaves(self, lo, hi):
+        # B+ tree: go down once to the leaf where lo would be, then follow the next leaf links,
+        # the internal nodes are not read again
+        node = self.readsNode(self.root)
+        while not node.is_leaf():
+            node = self.readsNode(node.children[0 if lo is None else bisect_left(node.keys, lo, 0, node.n)])
+        i = 0 if lo is None else bisect_left(node.keys, lo, 0, node.n)
+        while True:
+            n = node.n
+            if hi is not None and n and node.keys[n - 1] > hi: #the window ends in this leaf
+                end = bisect_right(node.keys, hi, i, n)
+                yield from zip(node.keys[i:end], node.values[i:end])
+                return
+            yield from zip(node.keys[i:n], node.values[i:n])
+            if node.children[self.fmt.next_slot] == 0:
+                return
+            node = self.readsNode(node.children[self.fmt.next_slot])
+            i = 0
+
+    def printAll(self, physical=False):
+        self.openAndLoadHeader() #makes sure its valid
+        for k, v in self.physical_pairs() if physical else self.scan(): #every pair in order
             print(f"{k} {v}") #print the key and value
-        self._inorder_traverse(self.root, printer) #traverse in order
 
-    def extractCSV(self, outpath):
+    def printRange(self, lo, hi):
+        self.openAndLoadHeader() #makes sure its valid
+        for k, v in self.scan(lo, hi): #only the pairs inside the window
+            print(f"{k} {v}")
+
+    def extractCSV(self, outpath, physical=False):
         self.openAndLoadHeader() #validate it first
         if os.path.exists(outpath): #if the file already exists
             print("Error: output file already exists", file=sys.stderr) #tell the user it does and stop
             sys.exit(1)
         with open(outpath, 'w', newline='') as csvfile: #open and make the new file
             writer = csv.writer(csvfile) #writer to the file
-            def write_row(k, v):
+            for k, v in self.physical_pairs() if physical else self.scan():
                 writer.writerow([str(k), str(v)]) #write the key/value pair to the row
-            if self.root != 0:
-                self._inorder_traverse(self.root, write_row) #if we're not at the root, keep going
+
+    def extractBinary(self, outpath, physical=False):
+        # dumps every pair in key order as packed records, written a chunk at a time
+        self.openAndLoadHeader() #validate it first
+        if os.path.exists(outpath): #if the file already exists
+            print("Error: output file already exists", file=sys.stderr)
+            sys.exit(1)
+        count = 0
+        with open(outpath, 'wb') as f:
+            f.write(pair_header.pack(pair_magic, 0, pair_sorted_flag)) #count is filled in at the end
+            chunk = array('q')
+            for k, v in self.physical_pairs() if physical else self.scan():
+                chunk.append(k)
+                chunk.append(v)
+                if len(chunk) >= 2 * pair_chunk:
+                    count += self._write_pair_chunk(f, chunk)
+                    chunk = array('q')
+            count += self._write_pair_chunk(f, chunk)
+            f.seek(0)
+            f.write(pair_header.pack(pair_magic, count, pair_sorted_flag))
+
+    # Physical scans: the file front to back in big reads, wherever the blocks sit in the tree
+    def physical_nodes(self):
+        # yields (block id, node) for every block after the header in block order, node is None when the block
+        # is missing or cannot be decoded. Blocks changed in the pool or still only in the log come from there
+        page = self.fmt.page_size
+        per_read = max(1, physical_read_bytes // page)
+        fd = self._reader_fd()
+        bid = 1
+        while bid < self.next_block:
+            count = min(per_read, self.next_block - bid)
+            data = memoryview(os.pread(fd, count * page, self._block_offset(bid)))
+            self.counters['block_reads'] += count
+            for j in range(count):
+                b = bid + j
+                with self.mutex:
+                    node = self.pool.frames[b] if b in self.pool.dirty else None
+                if node is None:
+                    block, start = (self.wal_pages[b], 0) if b in self.wal_pages else (data, j * page)
+                    try:
+                        node = Node.from_bytes(block, start, self.fmt) if len(block) - start >= page else None
+                    except Exception: #a damaged packed head can ask for runs that are not there
+                        node = None
+                yield b, node
+            bid += count
+
+    def check(self):
+        # reads the whole file once, front to back, and checks every block against the header and the tree
+        # gives back a report with the problems found (an empty list when the file is sound)
+        self.openAndLoadHeader()
+        with self.reading():
+            return self._check()
+
+    def _check(self):
+        fmt = self.fmt
+        total = self.next_block
+        problems = []
+        size = os.path.getsize(self.path)
+        with self.mutex:
+            pending = self.pool.dirty | self.wal_pages.keys() #blocks only in memory or the log so far
+        if any(bid not in pending for bid in range(max(1, size // fmt.page_size), total)):
+            problems.append(f"file is {size} bytes, the header says {total} blocks of {fmt.page_size}")
+        # what every block is, by block id: 0 unreadable, 1 leaf, 2 internal, 3 free
+        kind = bytearray(total)
+        parents = array('q', bytes(8 * total))
+        counts = array('q', bytes(8 * total))
+        lows = array('q', bytes(8 * total))
+        highs = array('q', bytes(8 * total))
+        inner = {} #internal block id -> (keys, children)
+        after = {} #B+ leaf -> next leaf
+        for bid, node in self.physical_nodes():
+            if node is None:
+                problems.append(f"block {bid}: cannot be read")
+                continue
+            if node.block_id != bid:
+                problems.append(f"block {bid}: says it is block {node.block_id}")
+                continue
+            n = node.n
+            if n == free_marker:
+                kind[bid] = 3
+                parents[bid] = node.parent #the next free block
+                continue
+            if not 0 <= n <= fmt.max_keys:
+                problems.append(f"block {bid}: {n} keys, a node holds 0 to {fmt.max_keys}")
+                continue
+            if fmt.packed and node.packed_size() > fmt.page_size:
+                problems.append(f"block {bid}: does not fit its page")
+            keys = node.keys[:n]
+            if any(map(gt, keys[:-1], keys[1:])):
+                problems.append(f"block {bid}: keys are out of order")
+            parents[bid] = node.parent
+            counts[bid] = n
+            if n:
+                lows[bid], highs[bid] = min(keys), max(keys)
+            if node.is_leaf():
+                kind[bid] = 1
+                if fmt.bplus:
+                    after[bid] = node.children[fmt.next_slot]
+            else:
+                kind[bid] = 2
+                inner[bid] = (keys, node.children[:n + 1])
+
+        # walk the tree level by level from the root, using only what was read above
+        reached = bytearray(total)
+        leaves = [] #left to right
+        pairs = height = 0
+        level = [(self.root, None, None, 0)] if self.root != 0 else [] #block, lower and upper bound, parent
+        while level:
+            height += 1
+            below = []
+            for bid, lo, hi, parent in level:
+                if not 0 < bid < total or kind[bid] == 0 or kind[bid] == 3:
+                    what = 'a free block' if 0 < bid < total and kind[bid] == 3 else 'a block that is not a node'
+                    problems.append(f"{f'block {parent}' if parent else 'header'}: points at {bid}, {what}")
+                    continue
+                if reached[bid]:
+                    problems.append(f"block {bid}: reached twice from the root")
+                    continue
+                reached[bid] = 1
+                n = counts[bid]
+                if parents[bid] != parent:
+                    problems.append(f"block {bid}: parent is {parents[bid]}, it sits under {parent}")
+                if bid != self.root and n < fmt.min_degree - 1:
+                    problems.append(f"block {bid}: {n} keys, under the minimum of {fmt.min_degree - 1}")
+                if n and (lo is not None and lows[bid] < lo or hi is not None and highs[bid] > hi):
+                    problems.append(f"block {bid}: keys outside {lo} .. {hi} set by block {parent}")
+                if kind[bid] == 1:
+                    leaves.append(bid)
+                    pairs += n
+                    continue
+                if leaves:
+                    problems.append(f"block {bid}: internal node on the leaf level, leaves are not all as deep")
+                keys, children = inner[bid]
+                if not fmt.bplus:
+                    pairs += n
+                for i, child in enumerate(children):
+                    below.append((child, keys[i - 1] if i else lo, keys[i] if i < n else hi, bid))
+            if leaves and below:
+                problems.append(f"leaves at depth {height} and deeper, the tree is not balanced")
+                break
+            level = below
+        if fmt.bplus:
+            for bid, nxt in zip(leaves, leaves[1:] + [0]):
+                if after.get(bid) != nxt:
+                    problems.append(f"block {bid}: next leaf is {after.get(bid)}, should be {nxt}")
+
+        # the free list, and blocks that are neither in the tree nor free
+        on_list = bytearray(total)
+        bid = self.free_head
+        while bid != 0:
+            if not 0 < bid < total or kind[bid] != 3 or on_list[bid]:
+                problems.append(f"free list: block {bid} is not a free block, or the list loops")
+                break
+            on_list[bid] = 1
+            bid = parents[bid]
+        for bid in range(1, total):
+            if kind[bid] == 3 and not on_list[bid]:
+                problems.append(f"block {bid}: free but not on the free list")
+            elif kind[bid] in (1, 2) and not reached[bid]:
+                problems.append(f"block {bid}: in use but not in the tree")
+        return {
+            'blocks': total - 1,
+            'nodes': sum(reached),
+            'free_blocks': sum(on_list),
+            'keys': pairs,
+            'height': height,
+            'problems': problems,
+        }
+
+    def physical_pairs(self):
+        # every pair in key order from one front to back pass over the file. The nodes reachable from the root are
+        # kept in memory and walked in order, which puts the leaves in tree order; the pairs of a B-tree's internal
+        # nodes, a small share, are sorted and merged in between. Equal keys are merged by where they sit in the
+        # tree (an internal pair just before the first leaf of its right subtree), so duplicates come out as in print
+        self.openAndLoadHeader()
+        with self.reading():
+            nodes = {}
+            for bid, node in self.physical_nodes():
+                if node is not None and node.n > 0:
+                    n = node.n
+                    nodes[bid] = (node.keys[:n], node.values[:n], None if node.is_leaf() else node.children[:n + 1])
+            runs = []
+            inside = []
+            stack = [(nodes.pop(self.root), 0)] if self.root in nodes else []
+            while stack: #only what is in the tree, a leaked or stale block is left out
+                entry, i = stack.pop()
+                keys, values, children = entry
+                if children is None:
+                    runs.append((keys, values))
+                    continue
+                if i > 0 and not self.fmt.bplus:
+                    inside.append((keys[i - 1], len(runs), 0, values[i - 1])) #the next leaf starts its right subtree
+                if i < len(keys):
+                    stack.append((entry, i + 1))
+                child = nodes.pop(children[i], None)
+                if child is not None:
+                    stack.append((child, 0))
+            nodes = None
+        inside.sort(key=lambda e: e[:2])
+        leaf_pairs = ((k, at, 1, v) for at, (keys, values) in enumerate(runs) for k, v in zip(keys, values))
+        for k, _, _, v in heapq.merge(leaf_pairs, inside, key=lambda e: e[:3]):
+            yield k, v
+
+    @staticmethod
+    def _write_pair_chunk(f, chunk):
+        if sys.byteorder == 'little':
+            chunk.byteswap() #the file is big endian
+        f.write(chunk.tobytes())
+        return len(chunk) // 2
+
+    @staticmethod
+    def _read_pairs(f, count, chunk_records=pair_chunk):
+        # yields the count (key, value) records after the header, reading a chunk at a time
+        left = count
+        while left > 0:
+            take = min(left, chunk_records)
+            data = f.read(take * 16)
+            if len(data) != take * 16:
+                raise ValueError("binary pair file is shorter than its header says")
+            chunk = array('q')
+            chunk.frombytes(data)
+            if sys.byteorder == 'little':
+                chunk.byteswap()
+            yield from zip(chunk[0::2], chunk[1::2])
+            left -= take
+
+    def readFromBinary(self, binpath):
+        # loads a file written by extractBinary; a sorted file goes into an empty index without sorting or
+        # holding the pairs in memory
+        self.openAndLoadHeader()
+        if not os.path.exists(binpath):
+            print("Error: binary file does not exist", file=sys.stderr)
+            sys.exit(1)
+        with open(binpath, 'rb') as f:
+            head = f.read(pair_header.size)
+            if len(head) != pair_header.size or head[:8] != pair_magic:
+                print("Error: not a binary pair file", file=sys.stderr)
+                sys.exit(1)
+            _, count, flags = pair_header.unpack(head)
+            if os.path.getsize(binpath) != pair_header.size + count * 16:
+                print("Error: binary pair file is truncated or has extra bytes", file=sys.stderr)
+                sys.exit(1)
+            with self.writing():
+                self._load_pairs(f, count, flags)
+
+    def _load_pairs(self, f, count, flags):
+        pairs = self._read_pairs(f, count)
+        if self.root != 0:
+            for k, v in pairs:
+                self.insert(k, v)
+        elif flags & pair_sorted_flag:
+            self.bulkLoad(self._check_sorted(pairs), count)
+        else:
+            ordered = sorted(pairs, key=lambda kv: kv[0])
+            self.bulkLoad(ordered, count)
+
+    @staticmethod
+    def _check_sorted(pairs):
+        # passes pairs through, stopping before a bad tree gets built if the file lied about being sorted
+        last = None
+        for k, v in pairs:
+            if last is not None and k < last:
+                raise ValueError("binary pair file says it is sorted but is not")
+            last = k
+            yield k, v
+
+    def readFromCSVExternal(self, csvpath, workers=None, memory_mb=ingest_memory_mb, tmpdir=None):
+        # parses and sorts byte ranges of the csv in a process pool, spills each as a sorted binary run,
+        # then merges the runs in key order straight into the tree; memory stays inside memory_mb
+        self.openAndLoadHeader()
+        if not os.path.exists(csvpath):
+            print("Error: csv file does not exist", file=sys.stderr)
+            sys.exit(1)
+        workers = workers or os.cpu_count() or 1
+        budget = max(1, memory_mb) * 1024 * 1024
+        chunk_bytes = max(1 << 20, budget // (workers * ingest_bytes_per_csv_byte)) #csv text handed to one worker
+        spill_dir = tempfile.mkdtemp(prefix='ingest_', dir=tmpdir or os.path.dirname(os.path.abspath(self.path)))
+        try:
+            jobs = [(csvpath, start, end, os.path.join(spill_dir, f"run{i}.bin"))
+                    for i, (start, end) in enumerate(csv_chunk_bounds(csvpath, chunk_bytes))]
+            if workers == 1 or len(jobs) == 1:
+                results = [sort_csv_chunk(job) for job in jobs]
+            else:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                    results = list(pool.map(sort_csv_chunk, jobs))
+            for error, _, _ in results:
+                if error:
+                    print(f"Error: {error}", file=sys.stderr) #nothing has touched the tree yet
+                    sys.exit(1)
+            runs = [(run_path, count) for _, run_path, count in results if count]
+            total = sum(count for _, count in runs)
+            # every run gets an equal slice of half the budget for its read buffer during the merge
+            merge_records = max(1024, budget // (2 * merge_bytes_per_record * max(1, len(runs))))
+            files = [open(run_path, 'rb') for run_path, _ in runs]
+            try:
+                streams = []
+                for f, (_, count) in zip(files, runs):
+                    f.seek(pair_header.size)
+                    streams.append(self._read_pairs(f, count, merge_records))
+                merged = heapq.merge(*streams, key=lambda kv: kv[0]) #ties keep run order, so csv order
+                with self.writing(): #readers only wait for the merge, not the parsing and sorting
+                    if self.root == 0:
+                        self.bulkLoad(merged, total)
+                    else:
+                        for k, v in merged:
+                            self.insert(k, v)
+            finally:
+                for f in files:
+                    f.close()
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
 
     def readFromCSV(self, csvpath):
         self.openAndLoadHeader()
         if not os.path.exists(csvpath): #we need to make sure the file exist first, user needs to provide it
             print("Error: csv file does not exist", file=sys.stderr) #tell the user
             sys.exit(1)
+        rows = self._csv_rows(csvpath)
+        with self.reading():
+            empty = self.root == 0
+        if not empty:
+            with self.writing():
+                for k, v in rows: #nothing to gain from buffering, each row goes straight in
+                    self.insert(k, v) #insert this into the index
+            return
+        pairs = list(rows) #every key/value pair from the csv, in file order
+        with self.writing(): #one lock for the whole load, the csv was parsed without it
+            if self.root == 0:
+                # empty index, sort once and build the whole tree bottom up instead of inserting row by row
+                pairs.sort(key=lambda kv: kv[0]) #stable, so duplicate keys keep their csv order
+                self.bulkLoad(pairs, len(pairs))
+                return
+            for k, v in pairs: #another writer got in while the csv was parsed
+                self.insert(k, v)
+
+    @staticmethod
+    def _csv_rows(csvpath):
+        # yields the key/value pairs of the csv one row at a time
         with open(csvpath, 'r', newline='') as csvfile:
             reader = csv.reader(csvfile) #open the reader
             for row in reader: #iterates through the rows in the csv
@@ -425,127 +2499,900 @@ class BTreeFile:
                     sys.exit(1)
                 k = int(parts[0].strip()) # Converts key if it is a string and takes away blank space
                 v = int(parts[1].strip()) # Converts value if it is a string and takes away blank space
-                self.insert(k, v) #insert this into the index
+                yield k, v
+
+    # Bulk loading
+    @staticmethod
+    def _plan_level(entries, max_keys=max_keys):
+        # how many nodes one level needs for this many entries, and how many keys go in each node
+        # one entry sits between every two neighbouring nodes and moves up as a separator in the parent
+        nodes = -(-(entries + 1) // (max_keys + 1)) #ceiling division, fewest nodes that hold everything
+        base, extra = divmod(entries - (nodes - 1), nodes) #spread the keys evenly so the last node is not underfull
+        return [base + 1 if j < extra else base for j in range(nodes)]
+
+    def bulkLoad(self, pairs, count):
+        # builds the tree bottom up from count pairs already sorted by key
+        # only works on an empty index; every block is written exactly once, in order, then the header once
+        with self.writing():
+            self._bulk_load(pairs, count)
+
+    def _bulk_load(self, pairs, count):
+        if self.root != 0:
+            raise RuntimeError("Bulk load needs an empty index")
+        if count == 0:
+            return
+        if self.bloom is not None:
+            # the tree is empty, so the filter starts over sized for what is being loaded
+            if self.bloom.clean:
+                self.bloom._mark(0)
+            self.bloom = BloomFilter.sized(self.bloom.path, count, self.bloom.fp_rate)
+            pairs = self.bloom.adding(pairs)
+        if self.fmt.packed or self.fmt.bplus:
+            self._bulk_load_greedy(pairs)
+            return
+
+        # plan every level first (leaves first) so each node knows its parent block id before it gets written
+        levels = [self._plan_level(count, self.fmt.max_keys)]
+        while len(levels[-1]) > 1:
+            levels.append(self._plan_level(len(levels[-1]) - 1, self.fmt.max_keys))
+        firsts = [] #block id of the first node on each level
+        bid = self.next_block
+        for counts in levels:
+            firsts.append(bid)
+            bid += len(counts)
+
+        source = iter(pairs) #the pairs feeding the level being written
+        self.counters['block_writes'] += bid - firsts[0]
+        with self._bulk_file() as f:
+            f.seek(self._block_offset(firsts[0]))
+            for lvl, counts in enumerate(levels):
+                # parent block id for every node on this level
+                if lvl + 1 < len(levels):
+                    parents = []
+                    for p, c in enumerate(levels[lvl + 1]):
+                        parents.extend([firsts[lvl + 1] + p] * (c + 1)) #a parent with c keys has c + 1 children
+                else:
+                    parents = [0] #the root has no parent
+                separators = [] #pairs pushed up into the next level
+                child = firsts[lvl - 1] if lvl > 0 else 0 #next unused child block on the level below
+                for j, c in enumerate(counts):
+                    node = Node(block_id=firsts[lvl] + j, fmt=self.fmt)
+                    node.parent = parents[j]
+                    node.n = c
+                    for i in range(c):
+                        node.keys[i], node.values[i] = next(source)
+                    if lvl > 0:
+                        for i in range(c + 1):
+                            node.children[i] = child
+                            child += 1
+                    if j + 1 < len(counts):
+                        separators.append(next(source)) #the pair between this node and the next goes to the parent
+                    f.write(node.to_bytes())
+                source = iter(separators)
+            if self.wal:
+                f.flush()
+                os.fsync(f.fileno()) #the new blocks must be on disk before the logged header points at them
+                self.counters['fsyncs'] += 1
+
+        self.root = firsts[-1]
+        self.next_block = bid
+        self.writesHeader() #header written once, at the end
+        if self.inner is not None:
+            self.load_internal_index() #the new blocks never went through writesNode
+
+    def _bulk_file(self):
+        # a big write buffer for the blocks a bulk load streams out; a session's own descriptor is used
+        # under it instead of opening the file again
+        if self.session is not None:
+            return open(self.fp.fileno(), 'r+b', buffering=1 << 20, closefd=False)
+        self.counters['file_opens'] += 1
+        return open(self.path, 'r+b', buffering=1 << 20)
+
+    def _pack_level(self, source, seps, kids=None, copy_up=False):
+        # greedy packing: a node takes pairs until the next one would not fit its page (or max_keys),
+        # that pair goes up into seps and the next node starts after it. kids gives the child block ids of an
+        # internal level, one more than the pairs. Gives back (pairs, children) for each node in order
+        # with copy_up (B+ leaves) the pair that did not fit starts the next node and only its key goes up
+        # one node is held back so the last one can borrow from it if it ends up under t - 1 pairs
+        page = self.fmt.page_size
+        cap = self.fmt.max_keys
+        t = self.fmt.min_degree
+        packed = self.fmt.packed
+        internal = kids is not None
+        held = None
+        pairs = []
+        children = [next(kids)] if internal else []
+        kw = vmin = vmax = 0
+        cmin = cmax = children[0] if internal else 0
+        for key, value in source:
+            child = next(kids) if internal else 0
+            n = len(pairs) + 1
+            if pairs:
+                kw2 = max(kw, byte_width(key - pairs[-1][0]))
+                vmin2, vmax2 = min(vmin, value), max(vmax, value)
+            else:
+                kw2, vmin2, vmax2 = 0, value, value
+            cmin2, cmax2 = min(cmin, child), max(cmax, child)
+            size = packed_head.size + (n - 1) * kw2 + n * byte_width(vmax2 - vmin2)
+            if internal:
+                size += (n + 1) * byte_width(cmax2 - cmin2)
+            if n <= cap and (size <= page or not packed):
+                pairs.append((key, value))
+                if internal:
+                    children.append(child)
+                kw, vmin, vmax, cmin, cmax = kw2, vmin2, vmax2, cmin2, cmax2
+                continue
+            if held is not None:
+                yield held
+            held = (pairs, children)
+            kw = 0
+            cmin = cmax = child
+            children = [child] if internal else [] #its right child starts the next node
+            if copy_up:
+                seps.append((key, 0))
+                pairs = [(key, value)]
+                vmin = vmax = value
+                continue
+            seps.append((key, value)) #the pair that did not fit goes to the parent
+            pairs = []
+        if held is not None and len(pairs) < t - 1 and copy_up:
+            # same as below, without a separator pair between the two leaves
+            merged = held[0] + pairs
+            seps.pop()
+            cut = len(merged) - (t - 1)
+            seps.append((merged[cut][0], 0))
+            held = (merged[:cut], [])
+            pairs = merged[cut:]
+        elif held is not None and len(pairs) < t - 1:
+            # the held node closed near full (at least 2t - 2 pairs), so it can hand its tail over
+            # the last node gets exactly t - 1 pairs, which fit its page at any width
+            merged = held[0] + [seps.pop()] + pairs
+            kin = held[1] + children
+            cut = len(merged) - t #the new separator
+            seps.append(merged[cut])
+            held = (merged[:cut], kin[:cut + 1])
+            pairs, children = merged[cut + 1:], kin[cut + 1:]
+        if held is not None:
+            yield held
+        yield pairs, children
+
+    def _node_from_pairs(self, block_id, parent, pairs, children, next_leaf=0):
+        node = Node(block_id=block_id, fmt=self.fmt)
+        node.parent = parent
+        node.children[self.fmt.next_slot] = next_leaf
+        node.n = n = len(pairs)
+        node.keys[0:n] = array('q', [k for k, _ in pairs])
+        node.values[0:n] = array('q', [v for _, v in pairs])
+        node.children[0:len(children)] = array('q', children)
+        return node
+
+    def _bulk_load_greedy(self, pairs):
+        # how many pairs a packed page holds depends on their bytes, and a B+ tree keeps every pair in the leaves,
+        # so the levels cannot be planned from the count the way _plan_level does.
+        # The leaves are filled greedily and streamed out in order with no parent yet, the levels above them are
+        # small enough to build in memory, and each leaf gets its parent id patched in at the end
+        first = bid = self.next_block
+        seps = []
+        bplus = self.fmt.bplus
+        with self._bulk_file() as f:
+            f.seek(self._block_offset(first))
+            waiting = None #a B+ leaf is written once the next one exists, so it can point at it
+            for leaf, _ in self._pack_level(iter(pairs), seps, copy_up=bplus):
+                if waiting is not None:
+                    f.write(self._node_from_pairs(bid, 0, waiting, [], bid + 1 if bplus else 0).to_bytes())
+                    bid += 1
+                waiting = leaf
+            f.write(self._node_from_pairs(bid, 0, waiting, []).to_bytes())
+            bid += 1
+            levels = [] #(first block id, nodes) for every level above the leaves
+            kids = range(first, bid)
+            while len(kids) > 1:
+                above = []
+                nodes = list(self._pack_level(iter(seps), above, iter(kids)))
+                levels.append((bid, nodes))
+                kids = range(bid, bid + len(nodes))
+                bid += len(nodes)
+                seps = above
+            parents = [] #parent block id for every level, leaves first
+            for start, nodes in levels:
+                parents.append({child: start + j for j, (_, children) in enumerate(nodes) for child in children})
+            for lvl, (start, nodes) in enumerate(levels):
+                up = parents[lvl + 1] if lvl + 1 < len(levels) else {}
+                for j, (node_pairs, children) in enumerate(nodes):
+                    f.write(self._node_from_pairs(start + j, up.get(start + j, 0), node_pairs, children).to_bytes())
+            if levels:
+                for leaf in range(first, levels[0][0]):
+                    f.seek(self._block_offset(leaf) + 8) #parent field, right after the block id
+                    f.write(int_to_bytes(parents[0][leaf]))
+            if self.wal:
+                f.flush()
+                os.fsync(f.fileno()) #the new blocks must be on disk before the logged header points at them
+                self.counters['fsyncs'] += 1
+        self.counters['block_writes'] += bid - first
+
+        self.root = bid - 1 #the last block written is the root, or the only leaf
+        self.next_block = bid
+        self.writesHeader() #header written once, at the end
+        if self.inner is not None:
+            self.load_internal_index() #the new blocks never went through writesNode
+
+# External sort ingest helpers, module level so the process pool can pickle them
+def csv_chunk_bounds(csvpath, chunk_bytes):
+    # splits the file into (start, end) byte ranges of about chunk_bytes that each end on a line break
+    size = os.path.getsize(csvpath)
+    bounds = []
+    with open(csvpath, 'rb') as f:
+        start = 0
+        while start < size:
+            end = start + chunk_bytes
+            if end < size:
+                f.seek(end)
+                f.readline() #finish the line the cut landed in
+                end = f.tell()
+            else:
+                end = size
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+def parse_csv_pairs(text):
+    # the same row rules as readFromCSV: skip empty rows, take the first two fields as key and value
+    pairs = []
+    for row in csv.reader(io.StringIO(text, newline='')):
+        if not row:
+            continue
+        parts = row[0].split(',') if len(row) == 1 else row
+        if len(parts) < 2:
+            raise ValueError("malformed CSV line; expected key,value")
+        pairs.append((int(parts[0].strip()), int(parts[1].strip())))
+    return pairs
+
+def sort_csv_chunk(job):
+    # worker: parse one byte range, sort it and write it as a sorted binary run
+    # gives back (error or None, run path, pair count)
+    csvpath, start, end, run_path = job
+    with open(csvpath, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8')
+    try:
+        pairs = parse_csv_pairs(text)
+    except ValueError as e:
+        return str(e), run_path, 0
+    pairs.sort(key=lambda kv: kv[0]) #stable, duplicate keys keep their csv order
+    with open(run_path, 'wb') as f:
+        f.write(pair_header.pack(pair_magic, len(pairs), pair_sorted_flag))
+        for i in range(0, len(pairs), pair_chunk):
+            chunk = array('q')
+            for k, v in pairs[i:i + pair_chunk]:
+                chunk.append(k)
+                chunk.append(v)
+            BTreeFile._write_pair_chunk(f, chunk)
+    return None, run_path, len(pairs)
+
+# asyncio wrapper
+class AsyncBTreeFile:
+    # a BTreeFile for asyncio code: everything that can touch the disk runs on a small thread pool,
+    # so the event loop never waits on a page read. Gets for a key that is already being looked up share that
+    # lookup, threads missing the same block share one read (see readsNode), and puts that arrive while a batch
+    # is being written go in together as the next batch, under one write lock
+    def __init__(self, tree, workers=async_workers, put_batch=async_put_batch):
+        self.owned = not isinstance(tree, BTreeFile) #given a path, the wrapper opens and closes a session on it
+        self.tree = BTreeFile(tree) if self.owned else tree #a path or a BTreeFile set up already
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='btree')
+        self.put_batch = put_batch
+        self.lookups = {} #key -> the lookup in flight for it
+        self.puts = [] #(key, value, future) waiting for the next batch
+        self.writer = None #task writing the batches, None while there is nothing to write
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def open(self):
+        # raises for a missing or bad file instead of exiting
+        if self.owned:
+            await self._run(self.tree._open_session, 'rw') #one descriptor and the header in memory until close
+        else:
+            await self._run(self.tree.readsHeader)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def get(self, key):
+        # the value stored under key, or None
+        lookup = self.lookups.get(key)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._run(self._get, key))
+            self.lookups[key] = lookup
+            lookup.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(lookup) #a caller that gives up does not cancel it for the others
+
+    def _forget(self, key, lookup):
+        if self.lookups.get(key) is lookup: #a put may already have dropped it, and a new lookup taken its place
+            del self.lookups[key]
+
+    def _get(self, key):
+        with self.tree.reading(): #the value is taken out before a writer can change the node
+            node, i = self.tree.searchKey(key)
+            return None if node is None else node.values[i]
+
+    async def get_many(self, keys):
+        # values for all the keys in the order given (None where missing), through one search_many
+        return await self._run(self._get_many, list(keys))
+
+    def _get_many(self, keys):
+        return [value for _, value in self.tree.search_many(keys)]
+
+    async def put(self, key, value):
+        # returns once the pair is in the tree
+        done = asyncio.get_running_loop().create_future()
+        self.puts.append((key, value, done))
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self._write_puts())
+        await done
+
+    async def _write_puts(self):
+        try:
+            while self.puts:
+                batch = self.puts[:self.put_batch]
+                del self.puts[:self.put_batch]
+                try:
+                    await self._run(self._insert_batch, [(k, v) for k, v, _ in batch])
+                except Exception as e:
+                    for _, _, done in batch:
+                        if not done.done():
+                            done.set_exception(e)
+                    continue
+                for k, _, done in batch:
+                    self.lookups.pop(k, None) #a lookup started before the batch may have missed it
+                    if not done.done():
+                        done.set_result(None)
+        finally:
+            self.writer = None
+
+    def _insert_batch(self, pairs):
+        with self.tree.writing(): #one lock, header write and flush (or group commit) for the whole batch
+            for k, v in pairs:
+                self.tree.insert(k, v)
+
+    async def scan(self, lo=None, hi=None, chunk=async_scan_chunk):
+        # async for key, value in t.scan(lo, hi): pairs in key order, fetched chunk pairs at a time
+        # each chunk is its own scan from where the last one stopped, so no lock is held between chunks
+        skip = 0 #pairs with key lo that earlier chunks already gave back
+        while True:
+            pairs, lo, skip = await self._run(self.tree.scan_chunk, lo, hi, skip, chunk)
+            for pair in pairs:
+                yield pair
+            if len(pairs) < chunk:
+                return
+
+    async def close(self):
+        while self.writer is not None:
+            await self.writer #puts still waiting get written first
+        await self._run(self.tree.close)
+        self.executor.shutdown()
+
+# Index server
+class ServeSession:
+    # one client of the server: collects bytes until full lines come in and answers them into an output buffer.
+    # Lines that are waiting are answered together under one lock, until the buffer passes a cap; a range or
+    # print is answered a chunk at a time as the buffer drains, so a client that does not read holds up nobody else
+    def __init__(self, btf):
+        self.btf = btf
+        self.pending = b'' #a line that has not finished arriving yet
+        self.lines = deque() #words of every full line not answered yet
+        self.out = bytearray() #answers not sent yet
+        self.scan = None #(lo, hi, skip) of a range or print still being answered
+        self.closed = False #the client said quit
+        self.eof = False #the client will not send any more lines
+        self.changed = False #an insert happened since the last flush
+
+    def feed(self, data):
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop() #whatever is after the last newline is incomplete
+        self.lines.extend(line.decode('utf-8', 'replace').split() for line in lines)
+
+    def busy(self):
+        return not self.closed and (self.lines or self.scan is not None)
+
+    def answer(self, limit=serve_buffer_cap):
+        # answers waiting lines until the output buffer holds limit bytes, the rest wait until the client reads
+        if not self.busy() or len(self.out) >= limit:
+            return
+        # one lock for what is answered now, the write side only when a waiting line changes the tree
+        writes = any(words and words[0].lower() in serve_writes for words in self.lines)
+        with self.btf.writing() if writes else self.btf.reading():
+            while self.busy() and len(self.out) < limit:
+                if self.scan is not None:
+                    self.scan_more()
+                else:
+                    self.handle(self.lines.popleft())
+        self.flush_if_changed()
+
+    def scan_more(self):
+        lo, hi, skip = self.scan
+        pairs, lo, skip = self.btf.scan_chunk(lo, hi, skip, serve_scan_chunk)
+        self.out += ''.join(f"{k} {v}\n" for k, v in pairs).encode('utf-8')
+        if len(pairs) < serve_scan_chunk:
+            self.out += b"END\n" #multi line answers end with END
+            self.scan = None
+        else:
+            self.scan = (lo, hi, skip)
+
+    def handle(self, words):
+        if not words:
+            return #blank line, nothing to answer
+        cmd = words[0].lower()
+        try:
+            if cmd == "insert" and len(words) == 3:
+                self.btf.insert(int(words[1]), int(words[2]))
+                self.changed = True
+                reply = "OK\n"
+            elif cmd == "delete" and len(words) == 2:
+                removed = self.btf.delete(int(words[1]))
+                self.changed = True
+                reply = "OK\n" if removed is not None else "ERR key not found\n"
+            elif cmd == "search" and len(words) == 2:
+                node, idx = self.btf.searchKey(int(words[1]))
+                if node is None:
+                    reply = "ERR key not found\n"
+                else:
+                    reply = f"{node.keys[idx]} {node.values[idx]}\n"
+            elif cmd == "range" and len(words) == 3:
+                self.scan = (int(words[1]), int(words[2]), 0) #answered by scan_more as the buffer drains
+                reply = ""
+            elif cmd == "print" and len(words) == 1:
+                self.scan = (None, None, 0)
+                reply = ""
+            elif cmd == "flush" and len(words) == 1:
+                self.btf.flush()
+                self.changed = False
+                reply = "OK\n"
+            elif cmd == "quit" and len(words) == 1:
+                self.closed = True
+                reply = "OK\n"
+            else:
+                reply = "ERR unknown command or wrong number of arguments\n"
+        except (ValueError, OverflowError):
+            reply = "ERR keys and values must be 64-bit integers\n"
+        self.out += reply.encode('utf-8')
+
+    def flush_if_changed(self):
+        if self.changed:
+            self.btf.flush() #dirty nodes go to disk once per batch of lines, not once per insert
+            self.changed = False
+
+def serve_stdin(btf):
+    # answers commands from stdin on stdout until end of input or quit
+    session = ServeSession(btf)
+    while not session.closed:
+        data = os.read(sys.stdin.fileno(), serve_read_size)
+        if not data:
+            break
+        session.feed(data)
+        while True:
+            session.answer()
+            if not session.out:
+                break
+            sys.stdout.buffer.write(session.out)
+            sys.stdout.buffer.flush()
+            session.out.clear()
+
+def serve_events(session):
+    # what to wait for on a client: more lines while its answers fit under the cap, and room to send them
+    events = 0
+    if not session.eof and not session.closed and len(session.out) < serve_buffer_cap:
+        events |= selectors.EVENT_READ
+    if session.out:
+        events |= selectors.EVENT_WRITE
+    return events
+
+def serve_socket(btf, sock_path):
+    # answers commands from any number of clients on a unix socket on one thread; nothing blocks on one client,
+    # every socket is non-blocking and answers are sent from each client's buffer as its socket takes them
+    if os.path.exists(sock_path):
+        print("Error: socket path already exists", file=sys.stderr)
+        sys.exit(1)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(sock_path)
+    listener.listen()
+    listener.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ)
+    sessions = {} #client socket -> its session
+    try:
+        while True:
+            for key, mask in sel.select():
+                if key.fileobj is listener:
+                    conn, _ = listener.accept()
+                    conn.setblocking(False)
+                    sessions[conn] = ServeSession(btf)
+                    sel.register(conn, selectors.EVENT_READ)
+                    continue
+                conn = key.fileobj
+                session = sessions[conn]
+                try:
+                    if mask & selectors.EVENT_READ:
+                        data = conn.recv(serve_read_size)
+                        if data:
+                            session.feed(data)
+                        else:
+                            session.eof = True #answer what came in, then close
+                    if mask & selectors.EVENT_WRITE and session.out:
+                        sent = conn.send(session.out)
+                        del session.out[:sent]
+                except BlockingIOError:
+                    pass
+                except OSError: #the client went away
+                    session.closed = True
+                    session.out.clear()
+                session.answer()
+                events = serve_events(session)
+                if events:
+                    sel.modify(conn, events)
+                else:
+                    sel.unregister(conn)
+                    del sessions[conn]
+                    conn.close()
+    finally:
+        sel.close()
+        listener.close()
+        os.remove(sock_path)
 
 # Command-line passing
+known_options = {'cache-pages', 'cache-mb', 'mmap', 'socket', 'wal', 'wal-group', 'pin-internal', 'stats', 'format',
+                 'external', 'workers', 'memory', 'threads', 'no-lock', 'page-size',
+                 'packed', 'bplus', 'bloom', 'fp-rate', 'physical'}
+opened_trees = [] #every tree a command made, so --stats can report them when it finishes
+
 def usage_and_exit():
     print("Usage:")
-    print("  project3.py create <indexfile>")
+    print("  project3.py create <indexfile> [--page-size=<bytes>] [--packed] [--bplus]")
     print("  project3.py insert <indexfile> <key> <value>")
     print("  project3.py search <indexfile> <key>")
     print("  project3.py load <indexfile> <csvfile>")
-    print("  project3.py print <indexfile>")
-    print("  project3.py extract <indexfile> <csvfile>")
+    print("  project3.py print <indexfile> [--physical]")
+    print("  project3.py extract <indexfile> <csvfile> [--physical]")
+    print("  project3.py range <indexfile> <lo> <hi>")
+    print("  project3.py search-many <indexfile> <keysfile|->")
+    print("  project3.py serve <indexfile> [--socket=<path>]")
+    print("  project3.py delete <indexfile> <key>")
+    print("  project3.py vacuum <indexfile>")
+    print("  project3.py stats <indexfile>")
+    print("  project3.py bloom <indexfile> [--fp-rate=<p>]")
+    print("  project3.py check <indexfile>")
+    print("Options:")
+    print("  --cache-pages=<n>  keep up to n nodes in the buffer pool")
+    print("  --cache-mb=<mb>    size the buffer pool in megabytes instead")
+    print("  --mmap             read and write blocks through a memory map of the index file")
+    print("  --socket=<path>    serve on a unix socket instead of stdin/stdout")
+    print("  --wal              log changed blocks to <indexfile>.wal and commit them in groups")
+    print("  --wal-group=<n>    inserts per group commit (default 64)")
+    print("  --pin-internal     load every internal node into memory when the file is opened")
+    print("  --stats            print I/O, cache and timing counters to stderr when the command ends")
+    print("  --format=csv|bin   file format for load and extract, bin is packed big endian key/value records")
+    print("  --external         load a csv through sorted runs on disk (automatic past the memory budget)")
+    print("  --workers=<n>      processes parsing and sorting csv chunks (default: one per cpu)")
+    print("  --memory=<mb>      memory budget for loading a csv (default 256)")
+    print("  --threads=<n>      threads looking up keys side by side in search-many")
+    print("  --no-lock          do not take fcntl locks on the index file")
+    print("  --page-size=<n>    page size for create, a multiple of 512 (default 512); the degree follows from it")
+    print("  --packed           create with compressed nodes, keys as gaps and values and children as small offsets")
+    print("  --bplus            create a B+ tree: pairs only in leaves linked in key order, internal nodes only steer")
+    print("  --bloom            load: build a <indexfile>.bloom filter first, so lookups of missing keys skip the tree")
+    print("  --fp-rate=<p>      false positive rate the bloom filter is sized for (default 0.01)")
+    print("  --physical         print/extract: read the file front to back in big chunks and sort the leaves in memory")
     sys.exit(1)
 
-def cmd_create(args): #argument for commands from the line
+def split_options(argv):
+    # pulls --name=value (or a bare --name) out of the arguments, everything else stays positional
+    args = []
+    opts = {}
+    for a in argv:
+        if a.startswith('--'):
+            name, eq, value = a[2:].partition('=')
+            opts[name] = value if eq else True
+        else:
+            args.append(a)
+    return args, opts
+
+def int_option(opts, name, default=None):
+    if name not in opts:
+        return default
+    try:
+        if isinstance(opts[name], bool):
+            raise TypeError(name) #bare flags come through as True, which is not a number we take
+        return int(opts[name])
+    except (TypeError, ValueError):
+        print(f"Error: --{name} needs a number", file=sys.stderr)
+        sys.exit(1)
+
+def fp_rate_option(opts):
+    try:
+        rate = float(opts.get('fp-rate', bloom_fp_rate))
+    except (TypeError, ValueError):
+        rate = 0
+    if not 0 < rate < 1:
+        print("Error: --fp-rate needs a number between 0 and 1", file=sys.stderr)
+        sys.exit(1)
+    return rate
+
+def tree_options(opts):
+    # BTreeFile settings from the command line: buffer pool size, modes and locking
+    return dict(cache_pages=int_option(opts, 'cache-pages'), cache_mb=int_option(opts, 'cache-mb'),
+                use_mmap=bool(opts.get('mmap')), wal=bool(opts.get('wal')),
+                wal_group=int_option(opts, 'wal-group', wal_group_ops), pin_internal=bool(opts.get('pin-internal')),
+                time_calls=bool(opts.get('stats')), lock_file=not opts.get('no-lock'))
+
+def tree_from_options(path, opts):
+    # builds the BTreeFile for a command with the buffer pool size the user asked for
+    btf = BTreeFile(path, **tree_options(opts))
+    opened_trees.append(btf)
+    return btf
+
+def open_from_options(path, opts, mode='rw'):
+    # opens the index for a command as a session: the file is checked here once and kept open until the command ends
+    if not os.path.exists(path):
+        print("Error: file does not exist", file=sys.stderr)
+        sys.exit(1)
+    try:
+        btf = BTreeFile.open(path, mode, **tree_options(opts))
+    except Exception: #not the right kind of file
+        print("Error: file is not a valid index file", file=sys.stderr)
+        sys.exit(1)
+    opened_trees.append(btf)
+    return btf
+
+def file_format(opts):
+    # --format=csv (the default) or --format=bin for load and extract
+    fmt = opts.get('format', 'csv')
+    if fmt not in ('csv', 'bin'):
+        print("Error: --format takes csv or bin", file=sys.stderr)
+        sys.exit(1)
+    return fmt
+
+def incoming_pairs(path, fmt):
+    # about how many pairs a load brings in: the count in a binary header, or the line breaks in a csv
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as f:
+        if fmt == 'bin':
+            head = f.read(pair_header.size)
+            return pair_header.unpack(head)[1] if len(head) == pair_header.size and head[:8] == pair_magic else 0
+        return sum(block.count(b'\n') for block in iter(lambda: f.read(1 << 20), b'')) + 1
+
+def report_stats():
+    # --stats: one line per counter on stderr, so it never mixes with a command's output
+    for btf in opened_trees:
+        for name, value in btf.stats().items():
+            if name == 'timings':
+                for call, t in value.items():
+                    print(f"stats: time {call} calls={t['calls']} seconds={t['seconds']}", file=sys.stderr)
+            else:
+                print(f"stats: {name} {value}", file=sys.stderr)
+
+def cmd_create(args, opts): #argument for commands from the line
     if len(args) != 2: #if there are too many or not enough arguments, exit
         usage_and_exit()
     path = args[1] #path is filename, which should be the second command givem
-    btf = BTreeFile(path) #create the tree with the filename
-    btf.create()
+    btf = tree_from_options(path, opts) #create the tree with the filename
+    btf.create(int_option(opts, 'page-size', byte_blocks), bool(opts.get('packed')), bool(opts.get('bplus')))
 
-def cmd_insert(args):
+def cmd_insert(args, opts):
     if len(args) != 4: #incorrect number of arguments
         usage_and_exit()
     path = args[1] #first is the filename
     k = int(args[2]) #make sure its int, key
     v = int(args[3]) #then value
-    btf = BTreeFile(path) #filename is the btree
-    if not os.path.exists(path):
-        print("Error: file does not exist", file=sys.stderr) #if we can't find the file name, tell the user it doesn't exist
-        sys.exit(1)
-    try:
-        btf.readsHeader() #validate header
-    except Exception as e:
-        print("Error: file is not a valid index file", file=sys.stderr) #not the correct if the header is wrong
+    if not (int64_min <= k <= int64_max and int64_min <= v <= int64_max):
+        print("Error: keys and values must be 64-bit integers", file=sys.stderr)
         sys.exit(1)
-    btf.insert(k, v) #call the function to insert key/value pair
+    with open_from_options(path, opts) as btf: #validates the header, and writes back the dirty nodes at the end
+        btf.insert(k, v) #call the function to insert key/value pair
 
-def cmd_search(args): #search command
+def cmd_search(args, opts): #search command
     if len(args) != 3: #incorrect argument
         usage_and_exit()
     path = args[1] #filename
     k = int(args[2]) #make sure it's an int
-    btf = BTreeFile(path) #open the btree
-    if not os.path.exists(path): #error handling
-        print("Error: file does not exist", file=sys.stderr)
-        sys.exit(1)
-    try:
-        btf.readsHeader() #validate header
-    except Exception:
-        print("Error: file is not a valid index file", file=sys.stderr) #not the correct if the header is wrong
-        sys.exit(1)
-    node, idx = btf.searchKey(k)
-    if node is None:
-        print("Error: key not found", file=sys.stderr)
-        sys.exit(1)
-    print(f"{node.keys[idx]} {node.values[idx]}")
+    with open_from_options(path, opts, 'r') as btf: #open the btree
+        node, idx = btf.searchKey(k)
+        if node is None:
+            print("Error: key not found", file=sys.stderr)
+            sys.exit(1)
+        print(f"{node.keys[idx]} {node.values[idx]}")
 
-def cmd_load(args):
+def cmd_load(args, opts):
     if len(args) != 3:
         usage_and_exit()
     path = args[1]
     csvfile = args[2]
-    btf = BTreeFile(path)
-    if not os.path.exists(path):
-        print("Error: file does not exist", file=sys.stderr)
-        sys.exit(1)
-    try:
-        btf.readsHeader()
-    except Exception:
-        print("Error: file is not a valid index file", file=sys.stderr)
-        sys.exit(1)
-    btf.readFromCSV(csvfile)
+    with open_from_options(path, opts) as btf: #writes back the dirty nodes at the end
+        if opts.get('bloom'):
+            # from the keys already there, sized for the ones the load adds as it goes too
+            btf.build_bloom(fp_rate_option(opts), incoming_pairs(csvfile, file_format(opts)))
+        memory_mb = int_option(opts, 'memory', ingest_memory_mb)
+        if file_format(opts) == 'bin':
+            btf.readFromBinary(csvfile)
+        elif opts.get('external') or (os.path.exists(csvfile) and
+                                      os.path.getsize(csvfile) * ingest_bytes_per_csv_byte > memory_mb * 1024 * 1024):
+            # sorted runs on disk instead of one list in memory, also used on its own once parsing the csv in memory
+            # would outgrow the budget
+            btf.readFromCSVExternal(csvfile, workers=int_option(opts, 'workers'), memory_mb=memory_mb)
+        else:
+            btf.readFromCSV(csvfile)
+        if btf.bloom is not None and btf.bloom.estimated_fp() > btf.bloom.fp_rate:
+            btf.build_bloom(btf.bloom.fp_rate) #more keys came in than the filter was sized for
 
-def cmd_print(args): #print function
+def cmd_print(args, opts): #print function
     if len(args) != 2: #if there are too many or not enough arguments, exit
         usage_and_exit()
     path = args[1] #filename
-    btf = BTreeFile(path) #set path
-    if not os.path.exists(path): #checks to see if file exist
-        print("Error: file does not exist", file=sys.stderr)
-        sys.exit(1)
-    try:
-        btf.readsHeader() #try to do this
-    except Exception: #not the right kind of file
-        print("Error: file is not a valid index file", file=sys.stderr)
-        sys.exit(1)
-    btf.printAll() #call function to print it out
+    with open_from_options(path, opts, 'r') as btf: #checks the file exists and is an index file
+        btf.printAll(physical=bool(opts.get('physical'))) #call function to print it out
 
-def cmd_extract(args): #extrace command
+def cmd_extract(args, opts): #extrace command
     if len(args) != 3:
         usage_and_exit()
     path = args[1] #arguments
     out = args[2]
-    btf = BTreeFile(path) #btree from the file
-    if not os.path.exists(path):
-        print("Error: file does not exist", file=sys.stderr) #file doesn't exist
-        sys.exit(1)
+    with open_from_options(path, opts, 'r') as btf: #btree from the file
+        if file_format(opts) == 'bin':
+            btf.extractBinary(out, physical=bool(opts.get('physical')))
+        else:
+            btf.extractCSV(out, physical=bool(opts.get('physical'))) #calls the function
+
+def cmd_range(args, opts): #prints the pairs with lo <= key <= hi
+    if len(args) != 4:
+        usage_and_exit()
+    path = args[1]
+    lo = int(args[2])
+    hi = int(args[3])
+    with open_from_options(path, opts, 'r') as btf:
+        btf.printRange(lo, hi)
+
+def read_keys(keyfile):
+    # one key per line, blank lines skipped, read lazily so big key files stream through
+    for line in keyfile:
+        line = line.strip()
+        if line:
+            yield int(line)
+
+def cmd_search_many(args, opts): #looks up every key in a file (or stdin with -)
+    if len(args) != 3:
+        usage_and_exit()
+    path = args[1]
+    keys_path = args[2]
+    with open_from_options(path, opts, 'r') as btf: #validate header once for every key
+        if keys_path != '-' and not os.path.exists(keys_path):
+            print("Error: keys file does not exist", file=sys.stderr)
+            sys.exit(1)
+        keyfile = sys.stdin if keys_path == '-' else open(keys_path, 'r')
+        try:
+            for k, v in btf.search_many(read_keys(keyfile), threads=max(1, int_option(opts, 'threads', 1))):
+                if v is None:
+                    print(f"{k} not found")
+                else:
+                    print(f"{k} {v}")
+        except ValueError:
+            print("Error: keys must be integers, one per line", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            if keyfile is not sys.stdin:
+                keyfile.close()
+
+def cmd_serve(args, opts): #keeps one tree open and answers commands until stopped
+    if len(args) != 2:
+        usage_and_exit()
+    path = args[1]
+    sock_path = opts.get('socket')
+    if sock_path is True:
+        usage_and_exit() #--socket needs a path
+    btf = open_from_options(path, opts)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) #a kill still runs the cleanup below
     try:
-        btf.readsHeader() #validate header
-    except Exception:
-        print("Error: file is not a valid index file", file=sys.stderr)
+        if sock_path:
+            serve_socket(btf, sock_path)
+        else:
+            serve_stdin(btf)
+    except KeyboardInterrupt:
+        pass #ctrl-c stops the server, the tree still gets closed below
+    finally:
+        btf.close() #writes back the dirty nodes
+
+def cmd_delete(args, opts): #removes one pair by key
+    if len(args) != 3:
+        usage_and_exit()
+    path = args[1]
+    k = int(args[2])
+    with open_from_options(path, opts) as btf: #writes back the dirty nodes at the end
+        removed = btf.delete(k)
+    if removed is None:
+        print("Error: key not found", file=sys.stderr)
+        sys.exit(1)
+
+def cmd_vacuum(args, opts): #rewrites the index compactly in key order
+    if len(args) != 2:
+        usage_and_exit()
+    path = args[1]
+    with open_from_options(path, opts) as btf:
+        btf.vacuum()
+
+def cmd_stats(args, opts): #shape of the tree and how much of the file is free
+    if len(args) != 2:
+        usage_and_exit()
+    path = args[1]
+    with open_from_options(path, opts, 'r') as btf:
+        for name, value in btf.tree_stats().items():
+            print(f"{name} {value}")
+
+def cmd_bloom(args, opts): #builds the bloom filter sidecar again from every key in the tree
+    if len(args) != 2:
+        usage_and_exit()
+    path = args[1]
+    with open_from_options(path, opts) as btf:
+        btf.build_bloom(fp_rate_option(opts))
+    print(f"Built {btf._bloom_path()} for {btf.bloom.count} keys")
+
+def cmd_check(args, opts): #reads every block in file order and checks the tree is sound
+    if len(args) != 2:
+        usage_and_exit()
+    path = args[1]
+    with open_from_options(path, opts, 'r') as btf:
+        report = btf.check()
+    for problem in report['problems']:
+        print(problem)
+    summary = f"{report['blocks']} blocks, {report['nodes']} nodes, {report['free_blocks']} free, {report['keys']} keys, height {report['height']}"
+    if report['problems']:
+        print(f"{len(report['problems'])} problems: {summary}")
         sys.exit(1)
-    btf.extractCSV(out) #calls the function
+    print(f"ok: {summary}")
 
 def main():
     if len(sys.argv) < 2:
         usage_and_exit()
-    cmd = sys.argv[1].lower()
-    args = sys.argv[1:]
+    args, opts = split_options(sys.argv[1:])
+    if not args or not set(opts) <= known_options:
+        usage_and_exit()
+    cmd = args[0].lower()
+    try:
+        run_command(cmd, args, opts)
+    finally:
+        if opts.get('stats'):
+            report_stats() #also after a command that stopped with an error
+
+def run_command(cmd, args, opts):
     if cmd == "create":
-        cmd_create(args)
+        cmd_create(args, opts)
     elif cmd == "insert":
-        cmd_insert(args)
+        cmd_insert(args, opts)
     elif cmd == "search":
-        cmd_search(args)
+        cmd_search(args, opts)
     elif cmd == "load":
-        cmd_load(args)
+        cmd_load(args, opts)
     elif cmd == "print":
-        cmd_print(args)
+        cmd_print(args, opts)
     elif cmd == "extract":
-        cmd_extract(args)
+        cmd_extract(args, opts)
+    elif cmd == "range":
+        cmd_range(args, opts)
+    elif cmd == "search-many":
+        cmd_search_many(args, opts)
+    elif cmd == "serve":
+        cmd_serve(args, opts)
+    elif cmd == "delete":
+        cmd_delete(args, opts)
+    elif cmd == "vacuum":
+        cmd_vacuum(args, opts)
+    elif cmd == "stats":
+        cmd_stats(args, opts)
+    elif cmd == "bloom":
+        cmd_bloom(args, opts)
+    elif cmd == "check":
+        cmd_check(args, opts)
     else:
         usage_and_exit()
 
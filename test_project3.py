@@ -0,0 +1,244 @@
+import os
+import sys
+import time
+import random
+import socket
+import subprocess
+
+import pytest
+
+from project3 import BTreeFile
+
+here = os.path.dirname(os.path.abspath(__file__))
+project_script = os.path.join(here, 'project3.py')
+
+def crash_after(path, script):
+    # runs script against a fresh index in a child process that dies with os._exit, so nothing is closed or flushed
+    code = (f"import os, sys\nsys.path.insert(0, {here!r})\nfrom project3 import BTreeFile\n"
+            f"path = {path!r}\n{script}\nos._exit(0)\n")
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+def lookup(t, key):
+    node, i = t.searchKey(key)
+    return None if node is None else node.values[i]
+
+def read_all(conn):
+    got = bytearray()
+    while True:
+        data = conn.recv(1 << 20)
+        if not data:
+            return bytes(got)
+        got += data
+
+def run_command(*args):
+    return subprocess.run([sys.executable, project_script, *args], capture_output=True, text=True)
+
+def test_wal_crash_then_cli_insert_keeps_committed_keys(tmp_path):
+    path = str(tmp_path / 'w.idx')
+    crash_after(path, "BTreeFile._write_empty_index(path)\n"
+                      "t = BTreeFile(path, wal=True, wal_group=10)\n"
+                      "for k in range(1005):\n    t.insert(k, k)")
+    assert os.path.exists(path + '.wal')
+    assert run_command('insert', path, '5000', '1').returncode == 0
+    out = run_command('check', path)
+    assert out.returncode == 0
+    assert ' 1001 keys,' in out.stdout #the 1000 keys of the committed groups and the new one
+
+def test_wal_crash_then_session_sees_committed_keys(tmp_path):
+    path = str(tmp_path / 'w.idx')
+    crash_after(path, "BTreeFile._write_empty_index(path)\n"
+                      "t = BTreeFile(path, wal=True, wal_group=10)\n"
+                      "for k in range(1005):\n    t.insert(k, k)")
+    with BTreeFile.open(path, 'rw', wal=True) as t:
+        assert [lookup(t, k) for k in (0, 500, 999)] == [0, 500, 999]
+        assert lookup(t, 1004) is None #its group was never committed
+    assert not os.path.exists(path + '.wal')
+
+def test_wal_group_after_torn_tail_survives_a_crash(tmp_path):
+    path = str(tmp_path / 'w.idx')
+    crash_after(path, "BTreeFile._write_empty_index(path)\n"
+                      "t = BTreeFile(path, wal=True, wal_group=10)\n"
+                      "for k in range(105):\n    t.insert(k, k)")
+    with open(path + '.wal', 'ab') as f:
+        f.write(b'junk' * 100) #a group the crash tore in half
+    # a shared lock only replays the log, the write lock that follows must not append after the tear
+    crash_after(path, "t = BTreeFile(path, lock_file=True, wal=True, wal_group=1)\n"
+                      "t.searchKey(5)\n"
+                      "t.insert(424242, 1)")
+    with BTreeFile.open(path, 'r', wal=True) as t:
+        assert lookup(t, 424242) == 1
+        assert lookup(t, 99) == 99
+
+def test_session_reads_the_header_once_under_a_lock(tmp_path):
+    path = str(tmp_path / 'p.idx')
+    BTreeFile._write_empty_index(path)
+    with BTreeFile.open(path, 'rw') as t:
+        for k in range(3000):
+            t.insert(k, k)
+    with BTreeFile.open(path, 'r', lock_file=True, pin_internal=True) as t:
+        pinned = t.stats()['block_reads']
+        assert lookup(t, 77) == 77
+        stats = t.stats()
+    assert stats['header_reads'] == 1
+    assert stats['block_reads'] == pinned + 1 #one leaf, the internal levels were loaded once
+
+def test_physical_print_keeps_duplicates_in_tree_order(tmp_path):
+    path = str(tmp_path / 'd.idx')
+    BTreeFile._write_empty_index(path)
+    with BTreeFile.open(path, 'rw') as t:
+        for v in range(3000):
+            t.insert(v * 7919 % 300, v) #ten of every key, inserted out of order
+    with BTreeFile.open(path, 'r') as t:
+        assert list(t.physical_pairs()) == list(t.scan())
+
+def test_time_calls_times_cache_hits_apart(tmp_path):
+    path = str(tmp_path / 't.idx')
+    BTreeFile._write_empty_index(path)
+    with BTreeFile.open(path, 'rw') as t:
+        t.insert(1, 1)
+    with BTreeFile.open(path, 'r', time_calls=True) as t:
+        for _ in range(3):
+            lookup(t, 1)
+        assert t.timings['readsNode'][0] == 1
+        assert t.timings['readsNode_hit'][0] == 2
+
+formats = [(512, False, False), (4096, False, False), (512, True, False), (512, False, True), (512, True, True)]
+format_ids = ['plain', 'plain-4k', 'packed', 'bplus', 'packed-bplus']
+
+def new_index(path, page_size=512, packed=False, bplus=False):
+    BTreeFile(path).create(page_size, packed, bplus)
+    return path
+
+@pytest.mark.parametrize('page_size, packed, bplus', formats, ids=format_ids)
+def test_random_inserts_and_deletes_match_a_dict(tmp_path, page_size, packed, bplus):
+    path = new_index(str(tmp_path / 'r.idx'), page_size, packed, bplus)
+    rng = random.Random(4348)
+    want = {}
+    with BTreeFile.open(path, 'rw', cache_pages=16) as t: #a small pool so evictions happen mid split and merge
+        for step in range(6000):
+            if want and rng.random() < 0.45:
+                key = rng.choice(list(want)) if rng.random() < 0.9 else rng.randrange(-10 ** 6, 0)
+                assert t.delete(key) == want.pop(key, None)
+            else:
+                key = rng.randrange(10 ** 6)
+                while key in want:
+                    key = rng.randrange(10 ** 6)
+                want[key] = rng.randrange(-(1 << 40), 1 << 40)
+                t.insert(key, want[key])
+            if step % 1500 == 1499:
+                t.flush()
+                assert t.check()['problems'] == []
+                assert list(t.scan()) == sorted(want.items())
+    with BTreeFile.open(path, 'r') as t:
+        report = t.check()
+        assert report['problems'] == []
+        assert report['keys'] == len(want)
+        assert list(t.scan()) == sorted(want.items())
+        assert list(t.scan(1000, 5000)) == [kv for kv in sorted(want.items()) if 1000 <= kv[0] <= 5000]
+
+@pytest.mark.parametrize('page_size, packed, bplus', formats, ids=format_ids)
+def test_deleting_everything_leaves_an_empty_tree(tmp_path, page_size, packed, bplus):
+    path = new_index(str(tmp_path / 'e.idx'), page_size, packed, bplus)
+    keys = list(range(2000))
+    with BTreeFile.open(path, 'rw') as t:
+        for k in keys:
+            t.insert(k, -k)
+        random.Random(1).shuffle(keys)
+        for k in keys:
+            assert t.delete(k) == -k
+        assert t.root == 0
+        assert t.delete(5) is None
+        assert t.check()['problems'] == []
+
+def test_freed_blocks_are_reused_before_the_file_grows(tmp_path):
+    path = new_index(str(tmp_path / 'f.idx'))
+    with BTreeFile.open(path, 'rw') as t:
+        for k in range(3000):
+            t.insert(k, k)
+        for k in range(0, 3000, 2):
+            t.delete(k)
+        t.flush()
+        freed = t.check()['free_blocks']
+        assert freed > 0
+        end = t.next_block
+        for k in range(0, 3000, 2):
+            t.insert(k, k)
+            if t.free_head != 0:
+                assert t.next_block == end #nothing new is allocated while the free list has blocks
+        t.flush()
+        report = t.check()
+        assert report['problems'] == []
+        assert report['free_blocks'] < freed
+        assert t.next_block == end or t.free_head == 0
+        assert list(t.scan()) == [(k, k) for k in range(3000)]
+
+@pytest.mark.parametrize('page_size, packed, bplus', formats, ids=format_ids)
+def test_vacuum_drops_free_blocks_and_keeps_every_pair(tmp_path, page_size, packed, bplus):
+    path = new_index(str(tmp_path / 'v.idx'), page_size, packed, bplus)
+    with BTreeFile.open(path, 'rw') as t:
+        for k in range(4000):
+            t.insert(k * 3 % 4000, k)
+        for k in range(0, 4000, 3):
+            t.delete(k)
+        t.flush()
+        want = list(t.scan())
+        before = t.check()
+        t.vacuum()
+        after = t.check()
+        assert after['problems'] == []
+        assert after['free_blocks'] == 0
+        assert after['blocks'] < before['blocks']
+        assert list(t.scan()) == want
+    assert os.path.getsize(path) == (after['blocks'] + 1) * page_size
+    with BTreeFile.open(path, 'r') as t:
+        assert list(t.scan()) == want
+
+def test_bloom_filter_rejects_missing_keys_without_reading_blocks(tmp_path):
+    path = new_index(str(tmp_path / 'b.idx'))
+    with BTreeFile.open(path, 'rw') as t:
+        for k in range(0, 20000, 2):
+            t.insert(k, k)
+        t.build_bloom()
+    with BTreeFile.open(path, 'r') as t:
+        assert t.bloom is not None
+        reads = t.stats()['block_reads']
+        missing = [lookup(t, k) for k in range(1, 20000, 2)]
+        assert missing == [None] * 10000
+        negatives = t.stats()['bloom_negatives']
+        assert negatives > 9500 #the filter is sized for a 1% false positive rate
+        assert t.stats()['block_reads'] - reads < 10000 - negatives + 100
+        assert [lookup(t, k) for k in range(0, 20000, 2)] == list(range(0, 20000, 2))
+    with BTreeFile.open(path, 'rw') as t:
+        t.insert(7, 70) #keys added later go into the filter too
+    with BTreeFile.open(path, 'r') as t:
+        assert t.bloom is not None
+        assert lookup(t, 7) == 70
+
+def test_serve_socket_answers_others_while_a_client_does_not_read(tmp_path):
+    path = new_index(str(tmp_path / 's.idx'))
+    with BTreeFile.open(path, 'rw') as t:
+        t.bulkLoad(((k, k) for k in range(200000)), 200000) #a print far bigger than the buffer cap
+    sock_path = str(tmp_path / 's.sock')
+    server = subprocess.Popen([sys.executable, project_script, 'serve', path, f'--socket={sock_path}'])
+    try:
+        for _ in range(100):
+            if os.path.exists(sock_path):
+                break
+            time.sleep(0.05)
+        stalled = socket.socket(socket.AF_UNIX)
+        stalled.connect(sock_path)
+        stalled.sendall(b'print\n') #never read until the end
+        time.sleep(0.2)
+        other = socket.socket(socket.AF_UNIX)
+        other.connect(sock_path)
+        other.settimeout(5)
+        other.sendall(b'search 7\ninsert 300000 1\nsearch 300000\nquit\n')
+        assert read_all(other) == b'7 7\nOK\n300000 1\nOK\n'
+        stalled.settimeout(30)
+        stalled.shutdown(socket.SHUT_WR)
+        lines = read_all(stalled).split(b'\n')
+        assert lines[-2] == b'END'
+        assert len(lines) - 2 in (200000, 200001) #the insert may land before or after the print got there
+    finally:
+        server.terminate()
+        server.wait()